@@ -0,0 +1,134 @@
+"""
+Compare HTTP/1.1 and HTTP/2 account clients against local stand-in server.
+
+Server answers every request after fixed delay (like GraphQL API) and counts TCP connections.
+Requires `pip install twscrape[http2]`.
+
+    python benchmarks/http2.py --requests 500 --concurrency 50 --delay 0.05
+"""
+
+import argparse
+import asyncio
+import time
+
+import h2.config
+import h2.connection
+import h2.events
+from httpx import AsyncHTTPTransport
+
+from twscrape.account import Account
+from twscrape.client_cache import ClientCache
+
+BODY = b'{"data": {}}'
+H2_PREFACE = b"PRI * HTTP/2.0"
+
+
+class Server:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.connections = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            data = await reader.read(65536)
+            if data.startswith(H2_PREFACE):
+                await self.handle_h2(data, reader, writer)
+            else:
+                await self.handle_h1(data, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_h1(self, data: bytes, reader, writer):
+        while data:
+            while b"\r\n\r\n" not in data:
+                data += await reader.read(65536)
+
+            _, data = data.split(b"\r\n\r\n", 1)  # GET requests, no body
+            await asyncio.sleep(self.delay)
+            head = f"HTTP/1.1 200 OK\r\ncontent-length: {len(BODY)}\r\n\r\n".encode()
+            writer.write(head + BODY)
+            await writer.drain()
+
+            data = data or await reader.read(65536)
+
+    async def handle_h2(self, data: bytes, reader, writer):
+        cfg = h2.config.H2Configuration(client_side=False)
+        conn = h2.connection.H2Connection(config=cfg)
+        conn.initiate_connection()
+
+        async def respond(stream_id: int):
+            await asyncio.sleep(self.delay)
+            headers = [(":status", "200"), ("content-length", str(len(BODY)))]
+            conn.send_headers(stream_id, headers)
+            conn.send_data(stream_id, BODY, end_stream=True)
+            writer.write(conn.data_to_send())
+
+        tasks = set()
+        while data:
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    task = asyncio.create_task(respond(event.stream_id))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            data = await reader.read(65536)
+
+
+async def run(url: str, http2: bool, requests: int, concurrency: int):
+    acc = Account("user1", "pass", "email", "pass", "ua", active=True)
+    cache = ClientCache()
+
+    # local server is plain text, so HTTP/2 is used with prior knowledge (h2c)
+    cache.loop = asyncio.get_running_loop()
+    cache.transports[(None, http2)] = AsyncHTTPTransport(retries=3, http1=not http2, http2=http2)
+    clt = await cache.get(acc, http2=http2)
+
+    limit = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one():
+        async with limit:
+            start = time.perf_counter()
+            rep = await clt.get(url)
+            rep.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    total = time.perf_counter() - start
+
+    await cache.aclose()
+    latencies.sort()
+    return total, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+async def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--delay", type=float, default=0.05, help="Server response delay, sec")
+    args = p.parse_args()
+
+    for http2 in [False, True]:
+        server = Server(args.delay)
+        srv = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        port = srv.sockets[0].getsockname()[1]
+
+        async with srv:
+            url = f"http://127.0.0.1:{port}/i/api/graphql/op/SearchTimeline"
+            total, p50, p99 = await run(url, http2, args.requests, args.concurrency)
+
+        name = "HTTP/2  " if http2 else "HTTP/1.1"
+        print(
+            f"{name} total {total:.2f}s, {args.requests / total:,.0f} req/s, "
+            f"p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms, connections {server.connections}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+Compare decoding every page response three times (QueueClient, API and parser) with decoding
+it once and reusing result cached on response. Both use same decoder (`twscrape.codec`), so only
+number of decodes differs. Uses responses from `tests/mocked-data`.
+
+    python benchmarks/parse_once.py --rounds 5
+"""
+
+import argparse
+import os
+import time
+
+import httpx
+
+from twscrape.codec import loads
+from twscrape.logger import set_log_level
+from twscrape.models import parse_tweets, parse_users
+from twscrape.utils import rep_json
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "tests", "mocked-data")
+USER_PAGES = ["followers", "following", "retweeters", "subscriptions", "user_by"]
+
+
+def load_pages():
+    pages = []
+    for name in sorted(os.listdir(DATA_DIR)):
+        if not name.startswith("raw_") or name == "raw_trends.json":
+            continue
+
+        with open(os.path.join(DATA_DIR, name), "rb") as fp:
+            parse = parse_users if any(x in name for x in USER_PAGES) else parse_tweets
+            pages.append((fp.read(), parse))
+
+    return pages
+
+
+def decode_each_time(rep: httpx.Response, parse):
+    loads(rep.content)  # QueueClient._check_rep
+    loads(rep.content)  # API._gql_items
+    return list(parse(loads(rep.content)))
+
+
+def decode_once(rep: httpx.Response, parse):
+    rep_json(rep)
+    rep_json(rep)
+    return list(parse(rep))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--rounds", type=int, default=5)
+    args = p.parse_args()
+
+    set_log_level("ERROR")
+    pages = load_pages()
+    size = sum(len(x[0]) for x in pages) / 1024 / 1024
+    print(f"{len(pages)} pages, {size:.1f} MB, {args.rounds} rounds")
+
+    for fn in [decode_each_time, decode_once]:
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for content, parse in pages:
+                fn(httpx.Response(200, content=content), parse)
+
+        took = time.perf_counter() - start
+        per_page = took / args.rounds / len(pages) * 1000
+        print(f"{fn.__name__:<16} {took:.3f}s, {per_page:.2f}ms/page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare paginated search with and without prefetch of next page. Server answers with page from
+`tests/mocked-data` after fixed delay, consumer spends fixed time per page (like db writes).
+
+    python benchmarks/prefetch.py --limit 400 --delay 0.1 --work 0.1
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from twscrape import API, AccountsPool
+from twscrape.logger import set_log_level
+from twscrape.models import parse_tweets
+from twscrape.queue_client import XClIdGenStore
+from twscrape.xclid import XClIdGen
+
+PAGE = os.path.join(os.path.dirname(__file__), "..", "tests", "mocked-data", "raw_search.json")
+
+
+async def run(prefetch: int, args) -> float:
+    with open(PAGE, "rb") as fp:
+        content = fp.read()
+
+    async def handler(req: httpx.Request):
+        await asyncio.sleep(args.delay)
+        return httpx.Response(200, content=content)
+
+    pool = AccountsPool(os.path.join(tempfile.mkdtemp(), "accounts.db"))
+    await pool.add_account("user1", "pass", "user1@example.com", "pass", cookies="ct0=ct0")
+
+    # same account client for all pages, network replaced with mock server
+    pool.clients.loop = asyncio.get_running_loop()
+    pool.clients.transports[(None, False)] = httpx.MockTransport(handler)
+
+    api, start, pages = API(pool, prefetch=prefetch), time.perf_counter(), 0
+    async for rep in api.search_raw("python", limit=args.limit):
+        list(parse_tweets(rep))
+        await asyncio.sleep(args.work)
+        pages += 1
+
+    took = time.perf_counter() - start
+    await pool.close()
+    print(f"prefetch={prefetch} {pages} pages in {took:.2f}s, {pages / took:.1f} pages/s")
+    return took
+
+
+async def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--limit", type=int, default=400, help="Tweets to load")
+    p.add_argument("--delay", type=float, default=0.1, help="Server response delay, sec")
+    p.add_argument("--work", type=float, default=0.1, help="Consumer time per page, sec")
+    args = p.parse_args()
+
+    set_log_level("ERROR")
+    XClIdGenStore.gen, XClIdGenStore.created_at = XClIdGen([0] * 48, "0"), time.time()
+
+    for prefetch in [0, 1, 2]:
+        await run(prefetch, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
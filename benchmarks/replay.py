@@ -0,0 +1,64 @@
+"""
+Run whole stack (pool, QueueClient, API, parsers) on recorded responses, without network and
+real accounts. Record archive once with real accounts:
+
+    TWS_RECORD=/tmp/search.jsonl.gz twscrape search "python" --limit 500
+
+Then replay it as many times as needed (`--latency 1` waits as long as recorded responses took):
+
+    python benchmarks/replay.py /tmp/search.jsonl.gz --query "python" --limit 500 --latency 1
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from twscrape import API, AccountsPool
+from twscrape.logger import set_log_level
+from twscrape.queue_client import XClIdGenStore
+from twscrape.xclid import XClIdGen
+
+
+async def run(args):
+    db_file = os.path.join(tempfile.mkdtemp(), "accounts.db")
+    pool = AccountsPool(db_file)
+    for i in range(args.accounts):
+        cookies = f"auth_token=token{i}; ct0=ct0{i}"
+        await pool.add_account(f"user{i}", "pass", f"user{i}@example.com", "pass", cookies=cookies)
+
+    # replayed responses don't check transaction id, so keys are not loaded from x.com
+    XClIdGenStore.gen, XClIdGenStore.created_at = XClIdGen([0] * 48, "0"), time.time()
+
+    api = API(pool)
+    for i in range(args.rounds):
+        start, count = time.perf_counter(), 0
+        async for _ in api.search(args.query, limit=args.limit):
+            count += 1
+
+        took = time.perf_counter() - start
+        print(f"round {i + 1}: {count} tweets in {took:.2f}s, {count / took:,.0f} tweets/s")
+
+    await pool.close()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("archive")
+    p.add_argument("--query", default="python")
+    p.add_argument("--limit", type=int, default=500)
+    p.add_argument("--accounts", type=int, default=5)
+    p.add_argument("--rounds", type=int, default=3)
+    p.add_argument("--latency", type=float, default=0.0, help="Part of recorded time to wait")
+    args = p.parse_args()
+
+    os.environ["TWS_REPLAY"] = args.archive
+    os.environ["TWS_REPLAY_LATENCY"] = str(args.latency)
+
+    set_log_level("ERROR")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -22,9 +22,11 @@ def mock_xclidgenstore(monkeypatch):
 
 
 @pytest.fixture
-def pool_mock(tmp_path):
+async def pool_mock(tmp_path):
     db_path = tmp_path / "test.db"
-    yield AccountsPool(db_path)
+    pool = AccountsPool(db_path)
+    yield pool
+    await pool.close()
 
 
 @pytest.fixture
@@ -1,10 +1,15 @@
+import asyncio
 import os
+from contextlib import aclosing
 
+import httpx
 import pytest
+from pytest_httpx import HTTPXMock
 
-from twscrape.accounts_pool import NoAccountError
+from twscrape.accounts_pool import AccountsPool, NoAccountError
 from twscrape.api import API
-from twscrape.utils import gather, get_env_bool
+from twscrape.hedge import HedgePolicy
+from twscrape.utils import gather, get_env_bool, utc
 
 
 class MockedError(Exception):
@@ -59,3 +64,51 @@ async def test_raise_when_no_account(api_mock: API):
 
     del os.environ["TWS_RAISE_WHEN_NO_ACCOUNT"]
     assert get_env_bool("TWS_RAISE_WHEN_NO_ACCOUNT") is False
+
+
+async def test_hedged_request(pool_mock: AccountsPool, httpx_mock: HTTPXMock):
+    pool_mock._order_by = "username"
+    for x in ["user1", "user2"]:
+        await pool_mock.add_account(x, "pass", f"{x}@example.com", "pass")
+        await pool_mock.set_active(x, True)
+
+    async def on_request(request: httpx.Request):
+        if request.headers["x-csrf-token"] != "ct0-user2":
+            await asyncio.sleep(5)  # slow account, should be cancelled
+        return httpx.Response(200, json={"data": {}})
+
+    httpx_mock.add_callback(on_request, is_reusable=True)
+    for x in ["user1", "user2"]:
+        acc = await pool_mock.get(x)
+        acc.headers["x-csrf-token"] = f"ct0-{x}"
+        await pool_mock.save(acc)
+
+    # should answer from second account and release both
+    api = API(pool_mock, hedge=HedgePolicy(default_delay=0.05))
+    rep = await api._gql_item("op/UserByScreenName", {})
+    assert rep is not None and getattr(rep, "__username") == "user2"
+    assert api.hedge is not None
+    assert api.hedge.stats == {"requests": 1, "hedged": 1, "hedge_won": 1}
+
+    for x in await pool_mock.get_all():
+        assert x.locks.get("UserByScreenName", utc.now()) <= utc.now()
+
+
+async def test_prefetch_pages(api_mock: API, httpx_mock: HTTPXMock):
+    with open(os.path.join(os.path.dirname(__file__), "mocked-data/raw_search.json"), "rb") as fp:
+        httpx_mock.add_response(content=fp.read(), is_reusable=True)
+
+    # should keep limit same as without prefetch
+    counts = []
+    for size in [0, 2]:
+        api_mock.prefetch = size
+        counts.append(len(await gather(api_mock.search("q", limit=50))))
+    assert counts[0] == counts[1] and counts[0] >= 50
+
+    # should release account when consumer stops early
+    async with aclosing(api_mock.search("q", limit=500)) as gen:
+        async for _ in gen:
+            break
+
+    acc = await api_mock.pool.get("user1")
+    assert acc.locks.get("SearchTimeline", utc.now()) <= utc.now()
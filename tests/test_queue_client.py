@@ -1,14 +1,27 @@
+import asyncio
+import gzip
+import os
 from contextlib import aclosing
 
 import httpx
+import pytest
 from pytest_httpx import HTTPXMock
 
 from twscrape.accounts_pool import AccountsPool
-from twscrape.queue_client import QueueClient
+from twscrape.db import execute, fetchone
+from twscrape.dumper import ResponseDumper
+from twscrape.metrics import REGISTRY, REQUESTS, serve, snapshot
+from twscrape.queue_client import QueueClient, XClIdGenStore
+from twscrape.replay import RecordTransport, ReplayTransport, wrap_transport
+from twscrape.retry import CircuitBreaker, RetryPolicy, RetryRule
+from twscrape.tracing import OpenTelemetryHooks, SpanRecorder, set_hooks, span
+from twscrape.utils import utc
+from twscrape.xclid import XClIdGen
 
 DB_FILE = "/tmp/twscrape_test_queue_client.db"
 URL = "https://example.com/api"
 CF = tuple[AccountsPool, QueueClient]
+STORE_GET = XClIdGenStore.get  # mocked in conftest
 
 
 async def get_locked(pool: AccountsPool) -> set[str]:
@@ -42,6 +55,22 @@ async def test_lock_account_when_used(httpx_mock: HTTPXMock, client_fixture):
     assert len(locked) == 0
 
 
+async def test_unlock_on_cancel(httpx_mock: HTTPXMock, client_fixture: CF):
+    pool, client = client_fixture
+
+    async def crawl():
+        async with client:
+            await asyncio.sleep(10)
+
+    task = asyncio.create_task(crawl())
+    await asyncio.sleep(0.1)
+    assert len(await get_locked(pool)) == 1
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert len(await get_locked(pool)) == 0
+
+
 async def test_do_not_switch_account_on_200(httpx_mock: HTTPXMock, client_fixture: CF):
     pool, client = client_fixture
 
@@ -117,6 +146,57 @@ async def test_retry_with_same_acc_on_network_error(httpx_mock: HTTPXMock, clien
     assert username is not None
 
 
+async def test_retry_policy(httpx_mock: HTTPXMock, client_fixture: CF):
+    pool, client = client_fixture
+    rule = RetryRule((httpx.ConnectError,), max_tries=3, backoff=0, switch_account=True)
+    client.retry = RetryPolicy([rule])
+
+    # should switch account on error
+    httpx_mock.add_exception(httpx.ConnectError("Connection refused"))
+    httpx_mock.add_response(url=URL, json={"foo": "1"}, status_code=200)
+    rep = await client.get(URL)
+    assert rep is not None
+    assert getattr(rep, "__username") == "user2"
+
+    # should raise after max tries
+    for _ in range(3):
+        httpx_mock.add_exception(httpx.ConnectError("Connection refused"))
+    with pytest.raises(httpx.ConnectError):
+        await client.get(URL)
+    await client.__aexit__(None, None, None)
+
+
+async def test_proxy_circuit_breaker(httpx_mock: HTTPXMock, pool_mock: AccountsPool):
+    pool_mock._order_by = "username"
+    pool_mock.breaker = CircuitBreaker(threshold=2, cooldown=60)
+    for i, proxy in [(1, "http://proxy1:80"), (2, "http://proxy2:80")]:
+        await pool_mock.add_account(f"user{i}", "pass", f"email{i}", "pass", proxy=proxy)
+        await pool_mock.set_active(f"user{i}", True)
+
+    rule = RetryRule((httpx.ConnectError,), max_tries=5, backoff=0)
+    client = QueueClient(pool_mock, "SearchTimeline", retry=RetryPolicy([rule]))
+
+    # should pause failing proxy and move to account with other proxy
+    for _ in range(2):
+        httpx_mock.add_exception(httpx.ConnectError("Connection refused"))
+    httpx_mock.add_response(url=URL, json={"foo": "1"}, status_code=200)
+
+    async with client:
+        rep = await client.get(URL)
+        assert rep is not None
+        assert getattr(rep, "__username") == "user2"
+
+    assert pool_mock.breaker.open_until("http://proxy1:80") > utc.ts()
+    assert pool_mock.breaker.open_until("http://proxy2:80") == 0
+    assert await get_locked(pool_mock) == {"user1"}
+
+    # should close breaker on success after cooldown
+    pool_mock.breaker.proxies["http://proxy1:80"].open_until = 0
+    assert pool_mock.breaker.failure("http://proxy1:80") is True  # probe failed, opened again
+    pool_mock.breaker.success("http://proxy1:80")
+    assert pool_mock.breaker.open_until("http://proxy1:80") == 0
+
+
 async def test_ctx_closed_on_break(httpx_mock: HTTPXMock, client_fixture: CF):
     pool, client = client_fixture
 
@@ -156,3 +236,284 @@ async def test_ctx_closed_on_break(httpx_mock: HTTPXMock, client_fixture: CF):
 
     # ctx should be None after break
     assert client.ctx is None
+
+
+async def test_save_rate_limit_on_release(httpx_mock: HTTPXMock, client_fixture: CF):
+    pool, client = client_fixture
+
+    headers = {"x-rate-limit-remaining": "42", "x-rate-limit-limit": "50"}
+    headers["x-rate-limit-reset"] = str(utc.ts() + 600)
+    httpx_mock.add_response(url=URL, json={"foo": "bar"}, status_code=200, headers=headers)
+
+    async with client:
+        await client.get(URL)
+
+    rs = await fetchone(pool._db_file, "SELECT * FROM account_locks WHERE username = 'user1'")
+    assert rs is not None
+    assert rs["limit_remaining"] == 42
+    assert rs["limit_max"] == 50
+    assert rs["req_count"] == 1
+
+
+async def test_reuse_client_between_sessions(httpx_mock: HTTPXMock, client_fixture: CF):
+    pool, client = client_fixture
+
+    headers = {"set-cookie": "ct0=new_ct0; Domain=.example.com; Path=/"}
+    httpx_mock.add_response(url=URL, json={"foo": "bar"}, status_code=200, headers=headers)
+    httpx_mock.add_response(url=URL, json={"foo": "bar"}, status_code=200)
+
+    async with client:
+        await client.get(URL)
+        clt1 = client.ctx.clt  # type: ignore
+
+    # should save cookies updated by server
+    acc = await pool.get("user1")
+    assert acc.cookies["ct0"] == "new_ct0"
+    assert acc.headers["x-csrf-token"] == "new_ct0"
+
+    # should use same client in next session
+    async with client:
+        rep = await client.get(URL)
+        assert client.ctx.clt is clt1  # type: ignore
+        assert rep.request.headers["x-csrf-token"] == "new_ct0"  # type: ignore
+
+    # should make new client when account session changed (eg. relogin)
+    acc.cookies = {"ct0": "relogin_ct0"}
+    await pool.save(acc)
+    httpx_mock.add_response(url=URL, json={"foo": "bar"}, status_code=200)
+    async with client:
+        await client.get(URL)
+        assert client.ctx.clt is not clt1  # type: ignore
+
+
+async def test_http2_client(client_fixture: CF):
+    pytest.importorskip("h2")
+    pool, _ = client_fixture
+
+    async with QueueClient(pool, "SearchTimeline", http2=True) as client:
+        assert client.ctx is not None
+        assert list(pool.clients.transports.keys()) == [(None, True)]
+
+
+async def test_xclid_store(monkeypatch):
+    monkeypatch.setattr(XClIdGenStore, "get", STORE_GET)
+    monkeypatch.setattr(XClIdGenStore, "gen", None)
+    monkeypatch.setattr(XClIdGenStore, "task", None)
+
+    created = []
+
+    async def create():
+        await asyncio.sleep(0.01)
+        created.append(object())
+        return created[-1]
+
+    monkeypatch.setattr("twscrape.queue_client.XClIdGen.create", create)
+
+    # should create once for concurrent callers
+    gens = await asyncio.gather(*[XClIdGenStore.get() for _ in range(5)])
+    assert len(created) == 1 and all(x is created[0] for x in gens)
+
+    # should recreate once when rejected
+    gens = await asyncio.gather(*[XClIdGenStore.get(stale=gens[0]) for _ in range(5)])
+    assert len(created) == 2 and all(x is created[1] for x in gens)
+    assert await XClIdGenStore.get(stale=created[0]) is created[1]
+
+    # should refresh in background, returning current one meanwhile
+    monkeypatch.setattr(XClIdGenStore, "created_at", XClIdGenStore.created_at - 50 * 60)
+    assert await XClIdGenStore.get() is created[1]
+    await asyncio.sleep(0.05)
+    assert len(created) == 3 and await XClIdGenStore.get() is created[2]
+
+    # should wait for new one when expired
+    monkeypatch.setattr(XClIdGenStore, "created_at", XClIdGenStore.created_at - 2 * 60 * 60)
+    assert await XClIdGenStore.get() is created[3]
+
+
+async def test_xclid_store_persist(pool_mock: AccountsPool, monkeypatch):
+    monkeypatch.setattr(XClIdGenStore, "get", STORE_GET)
+    monkeypatch.setattr(XClIdGenStore, "gen", None)
+    monkeypatch.setattr(XClIdGenStore, "created_at", 0.0)
+    monkeypatch.setattr(XClIdGenStore, "task", None)
+
+    created = []
+
+    async def create():
+        created.append(XClIdGen([1, 2, len(created)], f"key{len(created)}"))
+        return created[-1]
+
+    monkeypatch.setattr("twscrape.queue_client.XClIdGen.create", create)
+
+    db_file = pool_mock._db_file
+    gen = await XClIdGenStore.get(db_file=db_file)
+    assert len(created) == 1
+
+    # should load saved keys on next run without fetching
+    monkeypatch.setattr(XClIdGenStore, "gen", None)
+    monkeypatch.setattr(XClIdGenStore, "created_at", 0.0)
+    gen = await XClIdGenStore.get(db_file=db_file)
+    assert len(created) == 1
+    assert (gen.vk_bytes, gen.anim_key) == ([1, 2, 0], "key0")
+
+    # should fetch new keys on 404 and not reuse rejected ones
+    gen = await XClIdGenStore.get(stale=gen, db_file=db_file)
+    assert len(created) == 2 and gen is created[1]
+
+    # should not reuse expired keys
+    monkeypatch.setattr(XClIdGenStore, "gen", None)
+    monkeypatch.setattr(XClIdGenStore, "created_at", 0.0)
+    await execute(db_file, "UPDATE xclid_keys SET created_at = created_at - 2 * 60 * 60")
+    assert await XClIdGenStore.get(db_file=db_file) is created[2]
+
+
+def test_response_dumper(tmp_path):
+    def make_rep(status: int):
+        rep = httpx.Response(status, json={"status": status}, request=httpx.Request("GET", URL))
+        setattr(rep, "__username", "user1")
+        return rep
+
+    # should keep only last files
+    dumper = ResponseDumper(str(tmp_path), gzip=True, max_files=3)
+    for _ in range(5):
+        dumper.submit(make_rep(200), "title")
+    dumper.close()
+
+    files = sorted(os.listdir(tmp_path))
+    assert files == [f"{x:05d}_200_user1.txt.gz" for x in [3, 4, 5]]
+    assert b'"status": 200' in gzip.decompress((tmp_path / files[0]).read_bytes())
+    assert dumper.stats["written"] == 5 and dumper.stats["deleted"] == 2
+
+    # should sample successful responses only
+    dumper = ResponseDumper(str(tmp_path / "sample"), sample=0.0)
+    dumper.submit(make_rep(200))
+    dumper.submit(make_rep(429))
+    dumper.close()
+    assert os.listdir(tmp_path / "sample") == ["00001_429_user1.txt"]
+    assert dumper.stats["skipped"] == 1
+
+    # should drop when writer is behind
+    dumper = ResponseDumper(str(tmp_path / "drop"), queue_size=2)
+    dumper._start = lambda: None
+    for _ in range(3):
+        dumper.submit(make_rep(200))
+    assert dumper.stats["dropped"] == 1
+
+
+async def test_record_replay(tmp_path, monkeypatch):
+    archive = str(tmp_path / "archive.jsonl.gz")
+    reset = int(utc.ts()) + 600
+
+    def handler(req: httpx.Request):
+        headers = {"x-rate-limit-remaining": "10", "x-rate-limit-reset": str(reset)}
+        headers["set-cookie"] = "auth_token=secret; Domain=.example.com; Path=/"
+        return httpx.Response(200, headers=headers, json={"page": req.url.params["page"]})
+
+    recorder = RecordTransport(httpx.MockTransport(handler), archive)
+    async with httpx.AsyncClient(transport=recorder) as clt:
+        for page in ["1", "2"]:
+            rep = await clt.get(URL, params={"page": page})
+            assert rep.json() == {"page": page}
+            assert rep.cookies["auth_token"] == "secret"
+    recorder.recorder.close()
+
+    # should not store session cookies
+    with gzip.open(archive, "rt") as fp:
+        assert "auth_token" not in fp.read()
+
+    # should serve recorded responses without network
+    monkeypatch.setenv("TWS_REPLAY", archive)
+    replay = wrap_transport(httpx.AsyncHTTPTransport())
+    assert isinstance(replay, ReplayTransport)
+
+    async with httpx.AsyncClient(transport=replay) as clt:
+        rep = await clt.get(URL, params={"page": "2"})
+        assert rep.json() == {"page": "2"}
+        assert rep.headers["x-rate-limit-remaining"] == "10"
+        assert abs(int(rep.headers["x-rate-limit-reset"]) - reset) <= 1
+        assert "set-cookie" not in rep.headers
+
+        # unknown params served from same path, unknown path is 404
+        rep = await clt.get(URL, params={"page": "3"})
+        assert rep.json() == {"page": "1"}
+        rep = await clt.get("https://example.com/other")
+        assert rep.status_code == 404
+
+
+async def test_metrics(httpx_mock: HTTPXMock, client_fixture: CF):
+    pool, client = client_fixture
+    REGISTRY.reset()
+
+    httpx_mock.add_response(url=URL, json={"foo": "1"}, status_code=200)
+    httpx_mock.add_response(url=URL, json={"errors": [{"message": "x"}]}, status_code=200)
+    async with client:
+        await client.get(URL)
+        await client.get(URL)
+
+    assert REQUESTS.values == {("SearchTimeline", "200"): 2}
+    errors = snapshot()["twscrape_errors_total"]["values"]
+    assert errors == [{"labels": {"queue": "SearchTimeline", "error": "api_error"}, "value": 1}]
+
+    # should expose metrics in prometheus format with pool gauges
+    server = await serve(port=0, pool=pool)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nhost: localhost\r\n\r\n")
+        text = (await reader.read()).decode()
+        writer.close()
+
+    assert text.startswith("HTTP/1.1 200 OK")
+    assert 'twscrape_requests_total{queue="SearchTimeline",status="200"} 2' in text
+    assert 'twscrape_request_seconds_bucket{queue="SearchTimeline",le="+Inf"} 2' in text
+    assert 'twscrape_request_seconds_count{queue="SearchTimeline"} 2' in text
+    assert 'twscrape_accounts{queue="SearchTimeline",state="available"} 2' in text
+
+
+async def test_tracing(httpx_mock: HTTPXMock, client_fixture: CF):
+    pool, client = client_fixture
+    httpx_mock.add_response(url=URL, json={"foo": "1"}, status_code=200)
+
+    recorder = SpanRecorder()
+    set_hooks(recorder)
+    try:
+        async with client:
+            with span("page", page=1):
+                await client.get(URL)
+    finally:
+        set_hooks(None)
+
+    names = [x.name for x in recorder.spans]  # in order of finish
+    assert names == ["acquire", "xclid", "network", "check", "request", "page"]
+
+    spans = {x.name: x for x in recorder.spans}
+    assert spans["network"].parent is spans["request"]
+    assert spans["request"].parent is spans["page"]
+    assert spans["request"].attrs["status"] == 200
+    assert spans["acquire"].attrs["username"] == "user1"
+    assert all(x.end is not None and x.end >= x.start for x in recorder.spans)
+    assert len(recorder.waterfall().splitlines()) == 6
+
+
+async def test_tracing_otel(httpx_mock: HTTPXMock, client_fixture: CF):
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    pool, client = client_fixture
+    httpx_mock.add_response(url=URL, json={"foo": "1"}, status_code=200)
+
+    exporter, provider = InMemorySpanExporter(), TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    set_hooks(OpenTelemetryHooks(provider.get_tracer("test")))
+    try:
+        async with client:
+            await client.get(URL)
+    finally:
+        set_hooks(None)
+
+    spans = {x.name: x for x in exporter.get_finished_spans()}
+    assert set(spans) == {"acquire", "xclid", "network", "check", "request"}
+    parent, request = spans["network"].parent, spans["request"].context
+    assert parent is not None and request is not None and parent.span_id == request.span_id
+    attrs = spans["request"].attributes
+    assert attrs is not None and attrs["twscrape.status"] == 200
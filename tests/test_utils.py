@@ -1,6 +1,12 @@
+import asyncio
+import json
+from datetime import datetime
+
+import httpx
 import pytest
 
-from twscrape.utils import parse_cookies
+from twscrape import codec
+from twscrape.utils import gather, parse_cookies, prefetch, rep_json
 
 
 def test_cookies_parse():
@@ -25,3 +31,65 @@ def test_cookies_parse():
     with pytest.raises(ValueError, match=r"Invalid cookie value: .+"):
         val = "{invalid}"
         assert parse_cookies(val) == {}
+
+
+def test_rep_json():
+    rep = httpx.Response(200, content=b'{"data": {"user": null}}')
+    obj = rep_json(rep)
+    assert obj == {"data": {"user": None}}
+    assert rep_json(rep) is obj  # decoded once
+
+    rep = httpx.Response(200, content=b"null")
+    assert rep_json(rep) is None and rep_json(rep) is None
+
+    with pytest.raises(json.JSONDecodeError):
+        rep_json(httpx.Response(200, content=b"<html>"))
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson", "msgspec"])
+def test_codec(backend: str, monkeypatch):
+    pytest.importorskip(backend)
+    monkeypatch.setattr(codec, "BACKEND", backend)
+
+    obj = {"id": 1, "text": "привет", "items": [1.5, None, True], "at": datetime(2024, 1, 2)}
+    val = codec.dumps(obj, default=str)
+    assert val == '{"id":1,"text":"привет","items":[1.5,null,true],"at":"2024-01-02 00:00:00"}'
+    assert codec.loads(val) == codec.loads(val.encode()) == {**obj, "at": "2024-01-02 00:00:00"}
+
+    with pytest.raises(json.JSONDecodeError):
+        codec.loads(b"<html>")
+
+
+async def test_prefetch():
+    log = []
+
+    async def pages(n: int, fail=False):
+        try:
+            for i in range(n):
+                log.append(f"get {i}")
+                await asyncio.sleep(0)
+                yield i
+            if fail:
+                raise ValueError("failed")
+        finally:
+            log.append("closed")
+
+    # should load next item while consumer works, but not more than `size` ahead
+    async for x in prefetch(pages(4), 1):
+        await asyncio.sleep(0.01)
+        log.append(f"use {x}")
+    assert log[:4] == ["get 0", "get 1", "use 0", "get 2"]
+    assert log.count("closed") == 1 and log[-1] == "use 3"
+
+    assert await gather(prefetch(pages(5), 3)) == [0, 1, 2, 3, 4]
+
+    # should raise error of generator to consumer
+    with pytest.raises(ValueError):
+        await gather(prefetch(pages(2, fail=True), 2))
+
+    # should stop generator when consumer stops
+    log.clear()
+    gen = prefetch(pages(100), 2)
+    assert await anext(gen) == 0
+    await gen.aclose()
+    assert log[-1] == "closed" and len(log) <= 4
@@ -2,6 +2,8 @@
 from .account import Account
 from .accounts_pool import AccountsPool, NoAccountError
 from .api import API
+from .hedge import HedgePolicy
 from .logger import set_log_level
 from .models import *  # noqa: F403
+from .retry import RetryPolicy, RetryRule
 from .utils import gather
@@ -1,17 +1,31 @@
-import json
 import os
 import sqlite3
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
 
-from httpx import AsyncClient, AsyncHTTPTransport
+from httpx import AsyncBaseTransport, AsyncClient, AsyncHTTPTransport
 
+from .codec import dumps, loads
 from .models import JSONTrait
+from .replay import wrap_transport
 from .utils import utc
 
+UNKNOWN_BUDGET = 1_000_000  # accounts without rate limit info are tried first
+
 TOKEN = "Bearer AAAAAAAAAAAAAAAAAAAAANRILgAAAAAAnNwIzUejRCOuH5E6I8xnZz4puTs%3D1Zv7ttfk8LF81IUq16cHjhLTvJu4FA33AGWWjCpTnA"
 
 
+@dataclass
+class RateLimit:
+    remaining: int
+    limit: int
+    reset: int  # unix time when rate limit window resets
+
+    def budget(self, now: int) -> int:
+        # requests left in current window (full limit when window already reset)
+        return self.remaining if self.reset > now else max(self.limit, self.remaining)
+
+
 @dataclass
 class Account(JSONTrait):
     username: str
@@ -33,30 +47,37 @@ class Account(JSONTrait):
     @staticmethod
     def from_rs(rs: sqlite3.Row):
         doc = dict(rs)
-        doc["locks"] = {k: utc.from_iso(v) for k, v in json.loads(doc["locks"]).items()}
-        doc["stats"] = {k: v for k, v in json.loads(doc["stats"]).items() if isinstance(v, int)}
-        doc["headers"] = json.loads(doc["headers"])
-        doc["cookies"] = json.loads(doc["cookies"])
+        doc["locks"] = {k: utc.from_iso(v) for k, v in loads(doc["locks"]).items()}
+        doc["stats"] = {k: v for k, v in loads(doc["stats"]).items() if isinstance(v, int)}
+        doc["headers"] = loads(doc["headers"])
+        doc["cookies"] = loads(doc["cookies"])
         doc["active"] = bool(doc["active"])
         doc["last_used"] = utc.from_iso(doc["last_used"]) if doc["last_used"] else None
         return Account(**doc)
 
     def to_rs(self):
         rs = asdict(self)
-        rs["locks"] = json.dumps(rs["locks"], default=lambda x: x.isoformat())
-        rs["stats"] = json.dumps(rs["stats"])
-        rs["headers"] = json.dumps(rs["headers"])
-        rs["cookies"] = json.dumps(rs["cookies"])
+        rs["locks"] = dumps(rs["locks"], default=lambda x: x.isoformat())
+        rs["stats"] = dumps(rs["stats"])
+        rs["headers"] = dumps(rs["headers"])
+        rs["cookies"] = dumps(rs["cookies"])
         rs["last_used"] = rs["last_used"].isoformat() if rs["last_used"] else None
         return rs
 
-    def make_client(self, proxy: str | None = None) -> AsyncClient:
+    def get_proxy(self, proxy: str | None = None) -> str | None:
         proxies = [proxy, os.getenv("TWS_PROXY"), self.proxy]
         proxies = [x for x in proxies if x is not None]
-        proxy = proxies[0] if proxies else None
+        return proxies[0] if proxies else None
+
+    def make_client(
+        self, proxy: str | None = None, transport: AsyncBaseTransport | None = None, http2=False
+    ) -> AsyncClient:
+        # shared transport is already configured with proxy
+        if transport is None:
+            proxy = self.get_proxy(proxy)
+            transport = wrap_transport(AsyncHTTPTransport(proxy=proxy, retries=3, http2=http2))
 
-        transport = AsyncHTTPTransport(retries=3)
-        client = AsyncClient(proxy=proxy, follow_redirects=True, transport=transport)
+        client = AsyncClient(follow_redirects=True, transport=transport)
 
         # saved from previous usage
         client.cookies.update(self.cookies)
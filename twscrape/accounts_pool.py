@@ -1,17 +1,34 @@
 import asyncio
-import sqlite3
+import os
+import socket
+import time
 import uuid
+from collections import defaultdict, deque
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import TypedDict
+from typing import Any, Iterable, TypedDict
 
-from fake_useragent import UserAgent
 from httpx import HTTPStatusError
 
-from .account import Account
-from .db import execute, fetchall, fetchone
+from .account import UNKNOWN_BUDGET, Account, RateLimit
+from .client_cache import ClientCache
+from .codec import dumps
+from .db import close, data_version, execute, fetchall, fetchone, transact
+from .imap import _get_imap_domain
 from .logger import logger
 from .login import LoginConfig, login
-from .utils import get_env_bool, parse_cookies, utc
+from .metrics import ACCOUNTS, LEASE_WAIT_SECONDS
+from .rate_limiter import Bucket, RateLimiter
+from .retry import CircuitBreaker
+from .scheduler import AccountsScheduler
+from .utils import get_env_bool, get_user_agent, parse_cookies, utc
+
+
+class QueueInfo(TypedDict):
+    queue: str
+    available: int
+    locked: int
+    next_unlock: datetime | None
 
 
 class NoAccountError(Exception):
@@ -27,24 +44,130 @@ class AccountInfo(TypedDict):
     error_msg: str | None
 
 
+# most remaining rate limit budget first (see `RateLimit.budget`), then sooner window reset.
+# budget depends on time, so it's computed in query, which runs on reader connection outside
+# of write lock (account is locked after by primary key, see `_get_and_lock`)
+ORDER_BY_BUDGET = f"""
+COALESCE(
+    CASE WHEN limit_reset > :now THEN limit_remaining ELSE MAX(limit_max, limit_remaining) END,
+    {UNKNOWN_BUDGET}
+) DESC, COALESCE(limit_reset, 0), username
+"""
+
+
+@dataclass
+class Lease:
+    account: Account
+    count: int = 1  # number of QueueClients using account now
+    req_count: int = 0
+    unlock_at: int = 0  # max requested lock time, account is not shared after it set
+    limit: RateLimit | None = None
+
+
+# every account has row for every used queue, so account lookup is index seek
+ADD_KNOWN_QUEUES = """
+INSERT OR IGNORE INTO account_locks (username, queue)
+SELECT a.username, l.queue FROM accounts a, (SELECT DISTINCT queue FROM account_locks) l
+WHERE {cond}
+"""
+
+
 def guess_delim(line: str):
     lp, rp = tuple([x.strip() for x in line.split("username")])
     return rp[0] if not lp else lp[-1]
 
 
+def _new_account(
+    username: str,
+    password: str,
+    email: str,
+    email_password: str,
+    user_agent: str | None = None,
+    proxy: str | None = None,
+    cookies: str | None = None,
+    mfa_code: str | None = None,
+):
+    account = Account(
+        username=username,
+        password=password,
+        email=email,
+        email_password=email_password,
+        user_agent=user_agent or get_user_agent(),
+        active=False,
+        locks={},
+        stats={},
+        headers={},
+        cookies=parse_cookies(cookies) if cookies else {},
+        proxy=proxy,
+        mfa_code=mfa_code,
+    )
+
+    if "ct0" in account.cookies:
+        account.active = True
+
+    return account
+
+
 class AccountsPool:
     # _order_by: str = "RANDOM()"
-    _order_by: str = "username"
+    # _order_by: str = "username"
+    _order_by: str = ORDER_BY_BUDGET
+    _sched_sync_interval = 1.0  # seconds between checks for changes made by other processes
+    _max_wait = 30.0  # recheck for accounts, releases by other processes seen by data_version
+    _lease_ttl = 60  # seconds, lock of leased account is renewed by heartbeat
 
     def __init__(
         self,
         db_file="accounts.db",
         login_config: LoginConfig | None = None,
         raise_when_no_account=False,
+        use_scheduler=False,
+        max_in_flight=1,
+        rate_limits: dict[str, Bucket] | None = None,
     ):
         self._db_file = db_file
         self._login_config = login_config or LoginConfig()
         self._raise_when_no_account = raise_when_no_account
+        self._known_queues: set[str] = set()  # queues with account_locks rows
+
+        # accounts leased by this process, same account can be given to several QueueClients
+        # at once (up to `max_in_flight` and its remaining rate limit), released to db by last
+        self._max_in_flight = max_in_flight
+        self._leases: defaultdict[str, dict[str, Lease]] = defaultdict(dict)
+
+        # leases are locked in db for `_lease_ttl` with owner id and renewed while process
+        # is alive, so accounts of crashed worker are available again soon
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._heartbeat: asyncio.Task | None = None
+
+        # http clients of accounts kept between QueueClient sessions
+        self.clients = ClientCache()
+        self.breaker = CircuitBreaker()  # network failures by proxy
+
+        # aggregate request rate of all accounts, by queue & proxy (TWS_RATE_LIMITS by default)
+        self.limiter = RateLimiter(db_file, rate_limits)
+
+        # in-memory scheduler, db used only to save changes. note: changes made by other
+        # AccountsPool instance in same process are not tracked, share pool instead
+        self._use_scheduler = use_scheduler or get_env_bool("TWS_SCHEDULER")
+        self._sched: AccountsScheduler | None = None
+        self._sched_version = -1
+        self._sched_checked = 0.0
+
+        # coroutines waiting for account, woken on release or by timer at next unlock time,
+        # one watcher wakes them when db changed by other process (eg. account released there)
+        self._waiters: defaultdict[str, deque[asyncio.Future]] = defaultdict(deque)
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._watcher: asyncio.Task | None = None
+
+    async def close(self):
+        for task in [self._heartbeat, self._watcher]:
+            if task is not None and not task.get_loop().is_closed():
+                task.cancel()
+        self._heartbeat = self._watcher = None
+
+        await self.clients.aclose()
+        await close(self._db_file)
 
     async def load_from_file(self, filepath: str, line_format: str):
         line_delim = guess_delim(line_format)
@@ -54,22 +177,52 @@ class AccountsPool:
         if not required.issubset(tokens):
             raise ValueError(f"Invalid line format: {line_format}")
 
-        accounts = []
-        with open(filepath, "r") as f:
-            lines = f.read().split("\n")
-            lines = [x.strip() for x in lines if x.strip()]
+        def parse():
+            with open(filepath, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
 
-            for line in lines:
-                data = [x.strip() for x in line.split(line_delim)]
-                if len(data) < len(tokens):
-                    raise ValueError(f"Invalid line: {line}")
+                    data = [x.strip() for x in line.split(line_delim)]
+                    if len(data) < len(tokens):
+                        raise ValueError(f"Invalid line: {line}")
 
-                data = data[: len(tokens)]
-                vals = {k: v for k, v in zip(tokens, data) if k != "_"}
-                accounts.append(vals)
+                    data = data[: len(tokens)]
+                    yield {k: v for k, v in zip(tokens, data) if k != "_"}
 
+        return await self.add_accounts(parse())
+
+    async def add_accounts(self, accounts: Iterable[dict[str, Any]]):
+        rs = await fetchall(self._db_file, "SELECT username FROM accounts")
+        known = {x["username"].lower() for x in rs}
+
+        rows, skipped = [], 0
         for x in accounts:
-            await self.add_account(**x)
+            if x["username"].lower() in known:
+                logger.debug(f"Account {x['username']} already exists")
+                skipped += 1
+                continue
+
+            known.add(x["username"].lower())
+            rows.append(self._save_params(_new_account(**x)))
+
+        if rows:
+            cols = list(rows[0].keys())
+            qs = f"""
+            INSERT OR IGNORE INTO accounts ({",".join(cols)})
+            VALUES ({",".join([f":{x}" for x in cols])})
+            """
+
+            async def insert(db):
+                await db.executemany(qs, rows)
+                await db.execute(ADD_KNOWN_QUEUES.format(cond="a.active = true"))
+
+            await transact(self._db_file, insert)
+            self._invalidate()
+
+        logger.info(f"Accounts added: {len(rows)}, skipped: {skipped}")
+        return {"inserted": len(rows), "skipped": skipped}
 
     async def add_account(
         self,
@@ -88,24 +241,9 @@ class AccountsPool:
             logger.warning(f"Account {username} already exists")
             return
 
-        account = Account(
-            username=username,
-            password=password,
-            email=email,
-            email_password=email_password,
-            user_agent=user_agent or UserAgent().safari,
-            active=False,
-            locks={},
-            stats={},
-            headers={},
-            cookies=parse_cookies(cookies) if cookies else {},
-            proxy=proxy,
-            mfa_code=mfa_code,
+        account = _new_account(
+            username, password, email, email_password, user_agent, proxy, cookies, mfa_code
         )
-
-        if "ct0" in account.cookies:
-            account.active = True
-
         await self.save(account)
         logger.info(f"Account {username} added successfully (active={account.active})")
 
@@ -118,32 +256,57 @@ class AccountsPool:
 
         qs = f"""DELETE FROM accounts WHERE username IN ({",".join([f'"{x}"' for x in usernames])})"""
         await execute(self._db_file, qs)
+        self._invalidate()
 
     async def delete_inactive(self):
         qs = "DELETE FROM accounts WHERE active = false"
         await execute(self._db_file, qs)
+        self._invalidate()
+
+    async def _fetch_accounts(self, qs: str, params: dict | None = None) -> list[Account]:
+        rs = await fetchall(self._db_file, qs, params)
+        accounts = [Account.from_rs(x) for x in rs]
+        if not accounts:
+            return accounts
+
+        # locks & stats are stored in separate table, see migration v5
+        qs = f"SELECT * FROM account_locks WHERE username IN (SELECT username FROM ({qs}))"
+        rs = await fetchall(self._db_file, qs, params)
+
+        items = {x.username.lower(): x for x in accounts}
+        for x in rs:
+            acc = items.get(x["username"].lower())
+            if acc is None:
+                continue
+
+            acc.stats[x["queue"]] = x["req_count"]
+            if x["unlock_at"] > 0:
+                acc.locks[x["queue"]] = utc.from_ts(x["unlock_at"])
+
+        return accounts
 
     async def get(self, username: str):
-        qs = "SELECT * FROM accounts WHERE username = :username"
-        rs = await fetchone(self._db_file, qs, {"username": username})
-        if not rs:
+        account = await self.get_account(username)
+        if not account:
             raise ValueError(f"Account {username} not found")
-        return Account.from_rs(rs)
+        return account
 
     async def get_all(self):
         qs = "SELECT * FROM accounts"
-        rs = await fetchall(self._db_file, qs)
-        return [Account.from_rs(x) for x in rs]
+        return await self._fetch_accounts(qs)
 
     async def get_account(self, username: str):
         qs = "SELECT * FROM accounts WHERE username = :username"
-        rs = await fetchone(self._db_file, qs, {"username": username})
-        if not rs:
-            return None
-        return Account.from_rs(rs)
+        rs = await self._fetch_accounts(qs, {"username": username})
+        return rs[0] if rs else None
+
+    @staticmethod
+    def _save_params(account: Account):
+        # legacy json columns, locks & stats updated only with `lock_until` / `unlock`
+        return {k: v for k, v in account.to_rs().items() if k not in ("locks", "stats")}
 
     async def save(self, account: Account):
-        data = account.to_rs()
+        data = self._save_params(account)
         cols = list(data.keys())
 
         qs = f"""
@@ -151,6 +314,27 @@ class AccountsPool:
         ON CONFLICT(username) DO UPDATE SET {",".join([f"{x}=excluded.{x}" for x in cols])}
         """
         await execute(self._db_file, qs, data)
+        await self._add_known_queues(account.username)
+        self._invalidate()
+
+    async def save_session(self, account: Account):
+        # only session columns, so account banned meanwhile (eg. by other process) stays inactive
+        qs = """
+        UPDATE accounts SET cookies = :cookies, headers = :headers
+        WHERE username = :username AND active = true
+        """
+        cookies, headers = dumps(account.cookies), dumps(account.headers)
+        params = {"username": account.username, "cookies": cookies, "headers": headers}
+        await execute(self._db_file, qs, params)
+
+        # own write, cached accounts updated in place instead of reloading scheduler
+        acc = self._sched.accounts.get(account.username.lower()) if self._sched else None
+        if acc is not None and acc is not account:
+            acc.cookies, acc.headers = dict(account.cookies), dict(account.headers)
+
+    async def _add_known_queues(self, username: str):
+        qs = ADD_KNOWN_QUEUES.format(cond="a.username = :username AND a.active = true")
+        await execute(self._db_file, qs, {"username": username})
 
     async def login(self, account: Account):
         try:
@@ -167,7 +351,13 @@ class AccountsPool:
         finally:
             await self.save(account)
 
-    async def login_all(self, usernames: list[str] | None = None):
+    async def login_all(
+        self,
+        usernames: list[str] | None = None,
+        concurrency=1,
+        proxy_concurrency=2,
+        imap_concurrency=4,
+    ):
         if usernames is None:
             qs = "SELECT * FROM accounts WHERE active = false AND error_msg IS NULL"
         else:
@@ -176,16 +366,34 @@ class AccountsPool:
 
         rs = await fetchall(self._db_file, qs)
         accounts = [Account.from_rs(rs) for rs in rs]
-        # await asyncio.gather(*[login(x) for x in self.accounts])
+
+        if self._login_config.manual:
+            concurrency = 1  # codes are read from stdin one by one
+
+        # logins from same ip / to same mail server are throttled, so limit them separately
+        limit = asyncio.Semaphore(max(1, concurrency))
+        by_proxy = defaultdict(lambda: asyncio.Semaphore(max(1, proxy_concurrency)))
+        by_imap = defaultdict(lambda: asyncio.Semaphore(max(1, imap_concurrency)))
 
         counter = {"total": len(accounts), "success": 0, "failed": 0}
-        for i, x in enumerate(accounts, start=1):
-            logger.info(f"[{i}/{len(accounts)}] Logging in {x.username} - {x.email}")
-            status = await self.login(x)
+
+        async def login_one(x: Account):
+            imap = _get_imap_domain(x.email) if "@" in x.email else None
+            async with by_proxy[x.get_proxy()], by_imap[imap], limit:
+                logger.info(f"Logging in {x.username} - {x.email}")
+                status = await self.login(x)
+
             counter["success" if status else "failed"] += 1
+            done = counter["success"] + counter["failed"]
+            logger.info(
+                f"[{done}/{counter['total']}] Logged in {counter['success']}, "
+                f"failed {counter['failed']}"
+            )
+
+        await asyncio.gather(*[login_one(x) for x in accounts])
         return counter
 
-    async def relogin(self, usernames: str | list[str]):
+    async def relogin(self, usernames: str | list[str], concurrency=1):
         usernames = usernames if isinstance(usernames, list) else [usernames]
         usernames = list(set(usernames))
         if not usernames:
@@ -195,96 +403,333 @@ class AccountsPool:
         qs = f"""
         UPDATE accounts SET
             active = false,
-            locks = json_object(),
             last_used = NULL,
             error_msg = NULL,
             headers = json_object(),
             cookies = json_object(),
-            user_agent = "{UserAgent().safari}"
+            user_agent = "{get_user_agent()}"
         WHERE username IN ({",".join([f'"{x}"' for x in usernames])})
         """
 
         await execute(self._db_file, qs)
-        await self.login_all(usernames)
 
-    async def relogin_failed(self):
+        qs = f"""UPDATE account_locks SET unlock_at = 0, owner = NULL WHERE username IN ({",".join([f'"{x}"' for x in usernames])})"""
+        await execute(self._db_file, qs)
+        self._invalidate()
+        await self.login_all(usernames, concurrency=concurrency)
+
+    async def relogin_failed(self, concurrency=1):
         qs = "SELECT username FROM accounts WHERE active = false AND error_msg IS NOT NULL"
         rs = await fetchall(self._db_file, qs)
-        await self.relogin([x["username"] for x in rs])
+        await self.relogin([x["username"] for x in rs], concurrency=concurrency)
 
     async def reset_locks(self):
-        qs = "UPDATE accounts SET locks = json_object()"
+        qs = "UPDATE account_locks SET unlock_at = 0, owner = NULL"
         await execute(self._db_file, qs)
+        self._invalidate()
+        self._wake()
 
     async def set_active(self, username: str, active: bool):
         qs = "UPDATE accounts SET active = :active WHERE username = :username"
         await execute(self._db_file, qs, {"username": username, "active": active})
+        self._invalidate()
+        if active:
+            await self._add_known_queues(username)
+            self._wake()
 
-    async def lock_until(self, username: str, queue: str, unlock_at: int, req_count=0):
-        qs = f"""
-        UPDATE accounts SET
-            locks = json_set(locks, '$.{queue}', datetime({unlock_at}, 'unixepoch')),
-            stats = json_set(stats, '$.{queue}', COALESCE(json_extract(stats, '$.{queue}'), 0) + {req_count}),
-            last_used = datetime({utc.ts()}, 'unixepoch')
-        WHERE username = :username
-        """
-        await execute(self._db_file, qs, {"username": username})
+    async def lock_until(
+        self,
+        username: str,
+        queue: str,
+        unlock_at: int,
+        req_count=0,
+        limit: RateLimit | None = None,
+    ):
+        await self._release(username, queue, unlock_at, req_count, limit)
+
+    async def unlock(self, username: str, queue: str, req_count=0, limit: RateLimit | None = None):
+        await self._release(username, queue, 0, req_count, limit)
+
+    async def _release(
+        self,
+        username: str,
+        queue: str,
+        unlock_at: int,
+        req_count=0,
+        limit: RateLimit | None = None,
+    ):
+        lease = self._leases[queue].get(username.lower(), None)
+        if lease is not None:
+            lease.count -= 1
+            lease.req_count += req_count
+            lease.unlock_at = max(lease.unlock_at, unlock_at)
+            lease.limit = limit or lease.limit
+            if lease.count > 0:
+                self._wake(queue)  # account can be shared again
+                return
+
+            del self._leases[queue][username.lower()]
+            unlock_at, req_count, limit = lease.unlock_at, lease.req_count, lease.limit
+
+        released = await transact(
+            self._db_file, lambda db: self._lock(db, username, queue, unlock_at, req_count, limit)
+        )
+        if not released:
+            logger.warning(f"Lease of {username} on {queue} expired and taken by other worker")
+            return
+
+        if self._sched is not None:
+            self._sched.set(username, queue, unlock_at, req_count, limit)
+
+        if unlock_at > 0:
+            if self._waiters[queue]:
+                self._set_timer(queue, unlock_at)
+        else:
+            self._wake(queue)
+
+    def set_rate_limit(self, username: str, queue: str, limit: RateLimit):
+        # latest rate limit of leased account, used to decide if it can be shared more
+        lease = self._leases[queue].get(username.lower(), None)
+        if lease is not None:
+            lease.limit = limit
+
+    def _share(self, queue: str) -> Account | None:
+        if self._max_in_flight <= 1:
+            return None
+
+        now, best, best_spare = utc.ts(), None, 0
+        for lease in self._leases[queue].values():
+            if lease.unlock_at > 0 or lease.count >= self._max_in_flight:
+                continue
+
+            # every QueueClient using account will make at least one more request
+            budget = lease.limit.budget(now) if lease.limit else UNKNOWN_BUDGET
+            spare = min(self._max_in_flight, budget) - lease.count
+            if spare > best_spare:
+                best, best_spare = lease, spare
+
+        if best is None:
+            return None
+
+        best.count += 1
+        return best.account
+
+    async def _lock(
+        self,
+        db,
+        username: str,
+        queue: str,
+        unlock_at: int,
+        req_count=0,
+        limit: RateLimit | None = None,
+        free_at: int | None = None,
+        owner: str | None = None,
+    ) -> bool:
+        # with `free_at` lock only if account is not locked at this time (eg. by other process),
+        # otherwise it's release, which is skipped if expired lease was taken by other worker
+        if free_at is not None:
+            cond = "WHERE account_locks.unlock_at < :free_at"
+        else:
+            cond = "WHERE account_locks.owner IS NULL OR account_locks.owner = :me"
 
-    async def unlock(self, username: str, queue: str, req_count=0):
         qs = f"""
-        UPDATE accounts SET
-            locks = json_remove(locks, '$.{queue}'),
-            stats = json_set(stats, '$.{queue}', COALESCE(json_extract(stats, '$.{queue}'), 0) + {req_count}),
-            last_used = datetime({utc.ts()}, 'unixepoch')
-        WHERE username = :username
+        INSERT INTO account_locks (username, queue, unlock_at, req_count, limit_remaining, limit_max, limit_reset, owner)
+        SELECT username, :queue, :unlock_at, :req_count, :remaining, :limit, :reset, :owner
+        FROM accounts WHERE username = :username
+        ON CONFLICT(username, queue) DO UPDATE SET
+            unlock_at = excluded.unlock_at,
+            owner = excluded.owner,
+            req_count = req_count + excluded.req_count,
+            limit_remaining = COALESCE(excluded.limit_remaining, limit_remaining),
+            limit_max = COALESCE(excluded.limit_max, limit_max),
+            limit_reset = COALESCE(excluded.limit_reset, limit_reset)
+        {cond}
         """
-        await execute(self._db_file, qs, {"username": username})
-
-    async def _get_and_lock(self, queue: str, condition: str):
+        params = {
+            "username": username,
+            "queue": queue,
+            "unlock_at": unlock_at,
+            "req_count": req_count,
+            "free_at": free_at,
+            "owner": owner,
+            "me": self._owner,
+            "remaining": limit.remaining if limit else None,
+            "limit": limit.limit if limit else None,
+            "reset": limit.reset if limit else None,
+        }
+
+        async with db.execute(qs, params) as cur:
+            if cur.rowcount == 0:
+                return False
+
+        qs = "UPDATE accounts SET last_used = datetime(:ts, 'unixepoch') WHERE username = :name"
+        await db.execute(qs, {"name": username, "ts": utc.ts()})
+        return True
+
+    async def _get_and_lock(self, queue: str, condition: str, params: dict | None = None):
         # if space in condition, it's a subquery, otherwise it's username
         condition = f"({condition})" if " " in condition else f"'{condition}'"
+        qs = f"SELECT username FROM accounts WHERE username = {condition}"
 
-        if int(sqlite3.sqlite_version_info[1]) >= 35:
-            qs = f"""
-            UPDATE accounts SET
-                locks = json_set(locks, '$.{queue}', datetime('now', '+15 minutes')),
-                last_used = datetime({utc.ts()}, 'unixepoch')
-            WHERE username = {condition}
-            RETURNING *
-            """
-            rs = await fetchone(self._db_file, qs)
-        else:
-            tx = uuid.uuid4().hex
-            qs = f"""
-            UPDATE accounts SET
-                locks = json_set(locks, '$.{queue}', datetime('now', '+15 minutes')),
-                last_used = datetime({utc.ts()}, 'unixepoch'),
-                _tx = '{tx}'
-            WHERE username = {condition}
-            """
-            await execute(self._db_file, qs)
+        # account picked by read query, so misses and sort by budget don't hold write lock,
+        # then locked only if still free (next one picked if taken by other process meanwhile)
+        tried: set[str] = set()
+        while True:
+            rs = await fetchone(self._db_file, qs, params)
+            if rs is None or rs[0] in tried:
+                return None
+
+            username = rs[0]
+            tried.add(username)
+
+            async def fn(db, username=username, now=utc.ts()):
+                lock_at = now + self._lease_ttl
+                return await self._lock(
+                    db, username, queue, lock_at, free_at=now, owner=self._owner
+                )
+
+            if await transact(self._db_file, fn):
+                return await self.get_account(username)
+
+    async def _add_queue(self, queue: str):
+        qs = """
+        INSERT OR IGNORE INTO account_locks (username, queue)
+        SELECT username, :queue FROM accounts WHERE active = true
+        """
+        await execute(self._db_file, qs, {"queue": queue})
+
+    def _invalidate(self):
+        self._sched = None
+
+    @staticmethod
+    def _rate_limit(rs) -> RateLimit:
+        return RateLimit(rs["limit_remaining"], rs["limit_max"] or -1, rs["limit_reset"] or 0)
+
+    async def _get_scheduler(self) -> AccountsScheduler:
+        if self._sched is not None:
+            if time.monotonic() - self._sched_checked < self._sched_sync_interval:
+                return self._sched
 
-            qs = f"SELECT * FROM accounts WHERE _tx = '{tx}'"
-            rs = await fetchone(self._db_file, qs)
+        self._sched_checked = time.monotonic()
+        version = await data_version(self._db_file)
+        if self._sched is None or version != self._sched_version:
+            qs = "SELECT * FROM account_locks WHERE limit_remaining IS NOT NULL"
+            rs = await fetchall(self._db_file, qs)
+            limits = [(x["username"], x["queue"], self._rate_limit(x)) for x in rs]
 
-        return Account.from_rs(rs) if rs else None
+            self._sched = AccountsScheduler(await self.get_all(), limits)
+            self._sched_version = version
+
+        return self._sched
+
+    async def _sched_lease(self, queue: str):
+        tried: set[str] = set()
+        while True:
+            sched = await self._get_scheduler()
+            now = utc.ts()
+            lock_at = now + self._lease_ttl
+
+            account = sched.lease(queue, lock_at)
+            if account is None:
+                return None
+
+            if account.username in tried:
+                # reloaded state gives same account again, don't spin until db agrees
+                self._invalidate()
+                return None
+            tried.add(account.username)
+
+            async def fn(db, username=account.username, lock_at=lock_at, now=now):
+                return await self._lock(
+                    db, username, queue, lock_at, free_at=now, owner=self._owner
+                )
+
+            try:
+                locked = await transact(self._db_file, fn)
+                if locked:
+                    return account
+            except BaseException:
+                self._invalidate()
+                raise
+
+            # account taken by other process, reload state
+            self._invalidate()
 
     async def get_for_queue(self, queue: str):
+        account = self._share(queue)
+        if account is not None:
+            return account
+
+        if self._use_scheduler:
+            account = await self._sched_lease(queue)
+        else:
+            account = await self._db_lease(queue)
+
+        if account is not None:
+            self._leases[queue][account.username.lower()] = Lease(account)
+            self._start_heartbeat()
+
+        return account
+
+    def _start_heartbeat(self):
+        task = self._heartbeat
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._heartbeat = asyncio.create_task(self._renew_leases())
+
+    async def _renew_leases(self):
+        while any(self._leases.values()):
+            await asyncio.sleep(self._lease_ttl / 3)
+
+            # only leases held in memory, row locked by cancelled lease call expires by itself
+            unlock_at = utc.ts() + self._lease_ttl
+            leased = [
+                (q, x.account.username) for q, xs in self._leases.items() for x in xs.values()
+            ]
+
+            async def renew(db):
+                qs = """
+                UPDATE account_locks SET unlock_at = :unlock_at
+                WHERE username = :username AND queue = :queue AND owner = :owner
+                """
+                for queue, username in leased:
+                    params = {"username": username, "queue": queue, "unlock_at": unlock_at}
+                    await db.execute(qs, {**params, "owner": self._owner})
+
+            try:
+                await transact(self._db_file, renew)
+            except Exception as e:
+                logger.warning(f"Failed to renew account leases: {e}")
+                continue
+
+            if self._sched is not None:
+                for queue, leases in self._leases.items():
+                    for key in leases:
+                        self._sched.set(key, queue, unlock_at)
+
+    async def _db_lease(self, queue: str):
         q = f"""
-        SELECT username FROM accounts
-        WHERE active = true AND (
-            locks IS NULL
-            OR json_extract(locks, '$.{queue}') IS NULL
-            OR json_extract(locks, '$.{queue}') < datetime('now')
-        )
+        SELECT username FROM account_locks
+        WHERE queue = :queue AND unlock_at < :now
+            AND EXISTS (SELECT 1 FROM accounts a WHERE a.username = account_locks.username AND a.active = true)
         ORDER BY {self._order_by}
         LIMIT 1
         """
 
-        return await self._get_and_lock(queue, q)
+        account = await self._get_and_lock(queue, q, {"queue": queue, "now": utc.ts()})
+        if account is None and queue not in self._known_queues:
+            # new queue, index accounts and try again. once queue has rows, misses mean locked
+            # accounts (accounts added later get rows of known queues on save)
+            qs = "SELECT 1 FROM account_locks WHERE queue = :queue LIMIT 1"
+            if await fetchone(self._db_file, qs, {"queue": queue}) is None:
+                await self._add_queue(queue)
+                account = await self._get_and_lock(queue, q, {"queue": queue, "now": utc.ts()})
+            else:
+                self._known_queues.add(queue)
+
+        return account
 
     async def get_for_queue_or_wait(self, queue: str) -> Account | None:
-        msg_shown = False
+        msg_shown, woken, start = False, False, time.perf_counter()
         while True:
             account = await self.get_for_queue(queue)
             if not account:
@@ -301,25 +746,105 @@ class AccountsPool:
                     logger.info(msg)
                     msg_shown = True
 
-                await asyncio.sleep(5)
+                woken = await self._wait_for_release(queue)
                 continue
             else:
                 if msg_shown:
                     logger.info(f"Continuing with account {account.username} on queue {queue}")
 
+                if woken:
+                    # several accounts can be released at once, pass wake up to next waiter
+                    self._wake(queue)
+
+            LEASE_WAIT_SECONDS.observe(time.perf_counter() - start, queue)
             return account
 
-    async def next_available_at(self, queue: str):
-        qs = f"""
-        SELECT json_extract(locks, '$."{queue}"') as lock_until
-        FROM accounts
-        WHERE active = true AND json_extract(locks, '$."{queue}"') IS NOT NULL
-        ORDER BY lock_until ASC
-        LIMIT 1
+    async def _wait_for_release(self, queue: str) -> bool:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[queue].append(fut)
+        self._set_timer(queue, await self._next_unlock_ts(queue))
+
+        self._start_watcher()
+
+        try:
+            await asyncio.wait([fut], timeout=self._max_wait)
+            return fut.done()
+        except asyncio.CancelledError:
+            if fut.done():
+                self._wake(queue)  # woken, but can't take account
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+
+            if fut in self._waiters[queue]:
+                self._waiters[queue].remove(fut)
+
+    def _start_watcher(self):
+        task = self._watcher
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._watcher = asyncio.create_task(self._watch_db())
+
+    async def _watch_db(self):
+        version = await data_version(self._db_file)
+        while any(self._waiters.values()):
+            await asyncio.sleep(self._sched_sync_interval)
+            try:
+                current = await data_version(self._db_file)
+            except Exception as e:
+                logger.warning(f"Failed to check accounts db version: {e}")
+                continue
+
+            # one waiter per queue checks db, it passes wake up further if account taken
+            if current != version:
+                version = current
+                self._wake()
+
+    def _wake(self, queue: str | None = None):
+        for name in [queue] if queue is not None else list(self._waiters.keys()):
+            waiters = self._waiters[name]
+            while waiters:
+                fut = waiters.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+                    break
+
+    def _set_timer(self, queue: str, unlock_at: int | None):
+        if unlock_at is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        # account available when current second is greater than `unlock_at`
+        when = loop.time() + max(unlock_at + 1 - time.time(), 0)
+
+        timer = self._timers.get(queue, None)
+        if timer is not None:
+            if timer.when() <= when:
+                return
+            timer.cancel()
+
+        def on_timer():
+            del self._timers[queue]
+            self._wake(queue)
+
+        self._timers[queue] = loop.call_at(when, on_timer)
+
+    async def _next_unlock_ts(self, queue: str) -> int | None:
+        if self._use_scheduler:
+            return (await self._get_scheduler()).next_unlock(queue)
+
+        qs = """
+        SELECT MIN(unlock_at) FROM account_locks
+        WHERE queue = :queue AND unlock_at > 0
+            AND EXISTS (SELECT 1 FROM accounts a WHERE a.username = account_locks.username AND a.active = true)
         """
-        rs = await fetchone(self._db_file, qs)
-        if rs:
-            now, trg = utc.now(), utc.from_iso(rs[0])
+        rs = await fetchone(self._db_file, qs, {"queue": queue})
+        return rs[0] if rs and rs[0] else None
+
+    async def next_available_at(self, queue: str):
+        unlock_at = await self._next_unlock_ts(queue)
+        if unlock_at:
+            now, trg = utc.now(), utc.from_ts(unlock_at)
             if trg < now:
                 return "now"
 
@@ -334,29 +859,54 @@ class AccountsPool:
         WHERE username = :username
         """
         await execute(self._db_file, qs, {"username": username, "error_msg": error_msg})
+        self._invalidate()
+        self.clients.discard(username)
 
-    async def stats(self):
-        def locks_count(queue: str):
-            return f"""
-            SELECT COUNT(*) FROM accounts
-            WHERE json_extract(locks, '$.{queue}') IS NOT NULL
-                AND json_extract(locks, '$.{queue}') > datetime('now')
-            """
-
-        qs = "SELECT DISTINCT(f.key) as k from accounts, json_each(locks) f"
-        rs = await fetchall(self._db_file, qs)
-        gql_ops = [x["k"] for x in rs]
+        # QueueClient doesn't release inactive account, so stop renewing its lease
+        qs = "UPDATE account_locks SET owner = NULL WHERE username = :username AND owner = :owner"
+        await execute(self._db_file, qs, {"username": username, "owner": self._owner})
 
-        config = [
-            ("total", "SELECT COUNT(*) FROM accounts"),
-            ("active", "SELECT COUNT(*) FROM accounts WHERE active = true"),
-            ("inactive", "SELECT COUNT(*) FROM accounts WHERE active = false"),
-            *[(f"locked_{x}", locks_count(x)) for x in gql_ops],
-        ]
+        # stop sharing account, other QueueClients will release it as usual
+        for leases in self._leases.values():
+            leases.pop(username.lower(), None)
 
-        qs = f"SELECT {','.join([f'({q}) as {k}' for k, q in config])}"
+    async def stats(self):
+        qs = """
+        SELECT COUNT(*) AS total,
+            COALESCE(SUM(active = true), 0) AS active,
+            COALESCE(SUM(active = false), 0) AS inactive
+        FROM accounts
+        """
         rs = await fetchone(self._db_file, qs)
-        return dict(rs) if rs else {}
+        res = dict(rs) if rs else {}
+        res.update({f"locked_{x['queue']}": x["locked"] for x in await self.queues_info()})
+        return res
+
+    async def queues_info(self):
+        # active accounts have row for every known queue, so single grouped pass is enough
+        qs = """
+        SELECT l.queue,
+            SUM(l.unlock_at <= :now) AS available,
+            SUM(l.unlock_at > :now) AS locked,
+            MIN(CASE WHEN l.unlock_at > :now THEN l.unlock_at END) AS next_unlock
+        FROM account_locks l JOIN accounts a ON a.username = l.username AND a.active = true
+        GROUP BY l.queue
+        """
+        rs = await fetchall(self._db_file, qs, {"now": utc.ts()})
+
+        items: list[QueueInfo] = []
+        for x in rs:
+            item: QueueInfo = {
+                "queue": x["queue"],
+                "available": x["available"],
+                "locked": x["locked"],
+                "next_unlock": utc.from_ts(x["next_unlock"]) if x["next_unlock"] else None,
+            }
+            items.append(item)
+            ACCOUNTS.set(item["available"], item["queue"], "available")
+            ACCOUNTS.set(item["locked"], item["queue"], "locked")
+
+        return sorted(items, key=lambda x: (-x["locked"], x["queue"]))
 
     async def accounts_info(self):
         accounts = await self.get_all()
@@ -4,10 +4,13 @@ from typing import Literal
 from httpx import Response
 
 from .accounts_pool import AccountsPool
+from .hedge import HedgePolicy
 from .logger import set_log_level
 from .models import Tweet, User, parse_trends, parse_tweet, parse_tweets, parse_user, parse_users
 from .queue_client import QueueClient
-from .utils import encode_params, find_obj, get_by_path
+from .retry import RetryPolicy
+from .tracing import span
+from .utils import encode_params, find_obj, get_by_path, get_env_bool, prefetch, rep_json
 
 # OP_{NAME} – {NAME} should be same as second part of GQL ID (required to auto-update script)
 OP_SearchTimeline = "AIdc203rPpK_k_2KWSdm7g/SearchTimeline"
@@ -80,6 +83,10 @@ class API:
         debug=False,
         proxy: str | None = None,
         raise_when_no_account=False,
+        http2=False,
+        retry: RetryPolicy | None = None,
+        hedge: HedgePolicy | None = None,
+        prefetch=0,
     ):
         if isinstance(pool, AccountsPool):
             self.pool = pool
@@ -89,6 +96,10 @@ class API:
             self.pool = AccountsPool(raise_when_no_account=raise_when_no_account)
 
         self.proxy = proxy
+        self.http2 = http2 or get_env_bool("TWS_HTTP2")  # requires `twscrape[http2]`
+        self.retry = retry
+        self.hedge = hedge  # opt-in, used for single item lookups
+        self.prefetch = prefetch  # pages requested ahead of consumer in paginated calls
         self.debug = debug
         if self.debug:
             set_log_level("DEBUG")
@@ -110,15 +121,32 @@ class API:
             return cur.get("value")
         return None
 
+    def _client(self, queue: str, **kwargs):
+        return QueueClient(
+            self.pool, queue, self.debug, self.proxy, self.http2, self.retry, **kwargs
+        )
+
     # gql helpers
 
     async def _gql_items(
         self, op: str, kv: dict, ft: dict | None = None, limit=-1, cursor_type="Bottom"
     ):
-        queue, cur, cnt, active = op.split("/")[-1], None, 0, True
+        gen = self._gql_pages(op, kv, ft, limit, cursor_type)
+        if self.prefetch > 0:
+            # next cursor known after page decoded, so next page loaded while this one consumed
+            gen = prefetch(gen, self.prefetch)
+
+        async with aclosing(gen) as gen:
+            async for rep in gen:
+                yield rep
+
+    async def _gql_pages(
+        self, op: str, kv: dict, ft: dict | None = None, limit=-1, cursor_type="Bottom"
+    ):
+        queue, cur, cnt, active, page = op.split("/")[-1], None, 0, True, 0
         kv, ft = {**kv}, {**GQL_FEATURES, **(ft or {})}
 
-        async with QueueClient(self.pool, queue, self.debug, proxy=self.proxy) as client:
+        async with self._client(queue) as client:
             while active:
                 params = {"variables": kv, "features": ft}
                 if cur is not None:
@@ -128,11 +156,13 @@ class API:
                 if queue in ("UserMedia",):
                     params["fieldToggles"] = {"withArticlePlainText": False}
 
-                rep = await client.get(f"{GQL_URL}/{op}", params=encode_params(params))
+                page += 1
+                with span("page", queue=queue, page=page):
+                    rep = await client.get(f"{GQL_URL}/{op}", params=encode_params(params))
                 if rep is None:
                     return
 
-                obj = rep.json()
+                obj = rep_json(rep)
                 els = get_by_path(obj, "entries") or []
                 els = [
                     x
@@ -153,9 +183,24 @@ class API:
     async def _gql_item(self, op: str, kv: dict, ft: dict | None = None):
         ft = ft or {}
         queue = op.split("/")[-1]
-        async with QueueClient(self.pool, queue, self.debug, proxy=self.proxy) as client:
-            params = {"variables": {**kv}, "features": {**GQL_FEATURES, **ft}}
-            return await client.get(f"{GQL_URL}/{op}", params=encode_params(params))
+        params = {"variables": {**kv}, "features": {**GQL_FEATURES, **ft}}
+        params = encode_params(params)
+
+        async def get(client: QueueClient):
+            async with client:
+                return await client.get(f"{GQL_URL}/{op}", params=params)
+
+        main = self._client(queue)
+        with span("item", queue=queue, hedged=self.hedge is not None):
+            if self.hedge is None:
+                return await get(main)
+
+            def backup():
+                # second account only if available now and not used by first request
+                exclude = [main.ctx.acc.username] if main.ctx else []
+                return get(self._client(queue, wait=False, exclude=exclude))
+
+            return await self.hedge.run(queue, lambda: get(main), backup)
 
     # search
 
@@ -175,14 +220,14 @@ class API:
     async def search(self, q: str, limit=-1, kv: KV = None):
         async with aclosing(self.search_raw(q, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_tweets(rep.json(), limit):
+                for x in parse_tweets(rep, limit):
                     yield x
 
     async def search_user(self, q: str, limit=-1, kv: KV = None):
         kv = {"product": "People", **(kv or {})}
         async with aclosing(self.search_raw(q, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_users(rep.json(), limit):
+                for x in parse_users(rep, limit):
                     yield x
 
     # user_by_id
@@ -274,7 +319,7 @@ class API:
     async def tweet_replies(self, twid: int, limit=-1, kv: KV = None):
         async with aclosing(self.tweet_replies_raw(twid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_tweets(rep.json(), limit):
+                for x in parse_tweets(rep, limit):
                     if x.inReplyToTweetId == twid:
                         yield x
 
@@ -291,7 +336,7 @@ class API:
     async def followers(self, uid: int, limit=-1, kv: KV = None):
         async with aclosing(self.followers_raw(uid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_users(rep.json(), limit):
+                for x in parse_users(rep, limit):
                     yield x
 
     # verified_followers
@@ -309,7 +354,7 @@ class API:
     async def verified_followers(self, uid: int, limit=-1, kv: KV = None):
         async with aclosing(self.verified_followers_raw(uid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_users(rep.json(), limit):
+                for x in parse_users(rep, limit):
                     yield x
 
     # following
@@ -324,7 +369,7 @@ class API:
     async def following(self, uid: int, limit=-1, kv: KV = None):
         async with aclosing(self.following_raw(uid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_users(rep.json(), limit):
+                for x in parse_users(rep, limit):
                     yield x
 
     # subscriptions
@@ -339,7 +384,7 @@ class API:
     async def subscriptions(self, uid: int, limit=-1, kv: KV = None):
         async with aclosing(self.subscriptions_raw(uid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_users(rep.json(), limit):
+                for x in parse_users(rep, limit):
                     yield x
 
     # retweeters
@@ -354,7 +399,7 @@ class API:
     async def retweeters(self, twid: int, limit=-1, kv: KV = None):
         async with aclosing(self.retweeters_raw(twid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_users(rep.json(), limit):
+                for x in parse_users(rep, limit):
                     yield x
 
     # user_tweets
@@ -377,7 +422,7 @@ class API:
     async def user_tweets(self, uid: int, limit=-1, kv: KV = None):
         async with aclosing(self.user_tweets_raw(uid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_tweets(rep.json(), limit):
+                for x in parse_tweets(rep, limit):
                     yield x
 
     # user_tweets_and_replies
@@ -400,7 +445,7 @@ class API:
     async def user_tweets_and_replies(self, uid: int, limit=-1, kv: KV = None):
         async with aclosing(self.user_tweets_and_replies_raw(uid, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_tweets(rep.json(), limit):
+                for x in parse_tweets(rep, limit):
                     yield x
 
     # user_media
@@ -486,7 +531,7 @@ class API:
         }
         async with aclosing(self.search_raw(q, limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_tweets(rep.json(), limit):
+                for x in parse_tweets(rep, limit):
                     yield x
 
     # Get current user bookmarks
@@ -512,5 +557,5 @@ class API:
     async def bookmarks(self, limit=-1, kv: KV = None):
         async with aclosing(self.bookmarks_raw(limit=limit, kv=kv)) as gen:
             async for rep in gen:
-                for x in parse_tweets(rep.json(), limit):
+                for x in parse_tweets(rep, limit):
                     yield x
@@ -3,18 +3,18 @@
 import argparse
 import asyncio
 import io
-import json
 import sqlite3
 from importlib.metadata import version
 
 import httpx
 
 from .api import API, AccountsPool
+from .codec import dumps
 from .db import get_sqlite_version
 from .logger import logger, set_log_level
 from .login import LoginConfig
 from .models import Tweet, User
-from .utils import print_table
+from .utils import print_table, rep_json
 
 
 class CustomHelpFormatter(argparse.HelpFormatter):
@@ -36,8 +36,8 @@ def to_str(doc: httpx.Response | Tweet | User | None) -> str:
     if doc is None:
         return "Not Found. See --raw for more details."
 
-    tmp = doc.json()
-    return tmp if isinstance(tmp, str) else json.dumps(tmp, default=str)
+    tmp = rep_json(doc) if isinstance(doc, httpx.Response) else doc.json()
+    return tmp if isinstance(tmp, str) else dumps(tmp, default=str)
 
 
 async def main(args):
@@ -61,19 +61,13 @@ async def main(args):
         rep = await pool.stats()
         total, active, inactive = rep["total"], rep["active"], rep["inactive"]
 
-        res = []
-        for k, v in rep.items():
-            if not k.startswith("locked") or v == 0:
-                continue
-            res.append({"queue": k, "locked": v, "available": max(active - v, 0)})
-
-        res = sorted(res, key=lambda x: x["locked"], reverse=True)
-        print_table(res, hr_after=True)
+        print_table([dict(x) for x in await pool.queues_info()], hr_after=True)
         print(f"Total: {total} - Active: {active} - Inactive: {inactive}")
         return
 
     if args.command == "add_accounts":
-        await pool.load_from_file(args.file_path, args.line_format)
+        rep = await pool.load_from_file(args.file_path, args.line_format)
+        print(f"Added {rep['inserted']} accounts, skipped {rep['skipped']} existing")
         print("\nNow run:\ntwscrape login_accounts")
         return
 
@@ -82,16 +76,16 @@ async def main(args):
         return
 
     if args.command == "login_accounts":
-        stats = await pool.login_all()
+        stats = await pool.login_all(concurrency=args.concurrency)
         print(stats)
         return
 
     if args.command == "relogin_failed":
-        await pool.relogin_failed()
+        await pool.relogin_failed(concurrency=args.concurrency)
         return
 
     if args.command == "relogin":
-        await pool.relogin(args.usernames)
+        await pool.relogin(args.usernames, concurrency=args.concurrency)
         return
 
     if args.command == "reset_locks":
@@ -176,6 +170,7 @@ def run():
     for cmd in login_commands:
         cmd.add_argument("--email-first", action="store_true", help="Check email first")
         cmd.add_argument("--manual", action="store_true", help="Enter email code manually")
+        cmd.add_argument("--concurrency", type=int, default=1, help="Parallel logins")
 
     subparsers.add_parser("reset_locks", help="Reset all locks")
     subparsers.add_parser("delete_inactive", help="Delete inactive accounts")
@@ -0,0 +1,116 @@
+import asyncio
+import time
+from dataclasses import dataclass
+
+from httpx import AsyncBaseTransport, AsyncClient, AsyncHTTPTransport, Limits
+
+from .account import Account
+from .replay import wrap_transport
+
+
+@dataclass
+class CachedClient:
+    client: AsyncClient
+    session: tuple  # account cookies, headers & user agent client was made with
+    used: int = 0  # number of QueueClients using it now
+    last_used: float = 0.0
+
+
+def _session(acc: Account):
+    return (dict(acc.cookies), dict(acc.headers), acc.user_agent)
+
+
+class ClientCache:
+    """
+    Keeps `AsyncClient` of every account & proxy between QueueClient sessions, so connections
+    stay open. Clients with same proxy share one transport (connection pool) – cookies and
+    headers are stored in client and sent per request, so sessions of accounts are not mixed.
+    Clients not used for `idle_timeout` seconds are evicted. With `http2` concurrent requests
+    are multiplexed over single connection per proxy.
+    """
+
+    def __init__(self, idle_timeout=300.0, keepalive_expiry=60.0):
+        self.idle_timeout = idle_timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.clients: dict[tuple[str, str | None, bool], CachedClient] = {}
+        self.transports: dict[tuple[str | None, bool], AsyncBaseTransport] = {}
+        self._last_sweep = time.monotonic()
+
+    def _check_loop(self):
+        # connections are bound to event loop, can't reuse them in new one
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop, self.clients, self.transports = loop, {}, {}
+
+    def _transport(self, proxy: str | None, http2: bool):
+        key = (proxy, http2)
+        if key not in self.transports:
+            limits = Limits(keepalive_expiry=self.keepalive_expiry)
+            transport = AsyncHTTPTransport(proxy=proxy, retries=3, limits=limits, http2=http2)
+            self.transports[key] = wrap_transport(transport)
+        return self.transports[key]
+
+    async def get(self, acc: Account, proxy: str | None = None, http2=False) -> AsyncClient:
+        self._check_loop()
+        await self._sweep()
+
+        proxy = acc.get_proxy(proxy)
+        key = (acc.username.lower(), proxy, http2)
+
+        item = self.clients.get(key, None)
+        if item is None or item.session != _session(acc):
+            # new account or session changed (eg. relogin)
+            client = acc.make_client(transport=self._transport(proxy, http2))
+            item = self.clients[key] = CachedClient(client, _session(acc))
+
+        item.used += 1
+        item.last_used = time.monotonic()
+        return item.client
+
+    def release(self, acc: Account, client: AsyncClient) -> bool:
+        """Copy cookies updated by server back to account. Returns True if session changed."""
+        item = next((x for x in self.clients.values() if x.client is client), None)
+        if item is not None:
+            item.used = max(item.used - 1, 0)
+            item.last_used = time.monotonic()
+
+        cookies = {x.name: x.value for x in client.cookies.jar if x.value is not None}
+        if cookies == acc.cookies:
+            return False
+
+        acc.cookies = cookies
+        if "ct0" in cookies:
+            client.headers["x-csrf-token"] = cookies["ct0"]
+            acc.headers["x-csrf-token"] = cookies["ct0"]
+
+        if item is not None:
+            item.session = _session(acc)
+        return True
+
+    def discard(self, username: str):
+        for key in [x for x in self.clients if x[0] == username.lower()]:
+            del self.clients[key]
+
+    async def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < min(self.idle_timeout, 10.0):
+            return
+
+        self._last_sweep = now
+        for key, item in list(self.clients.items()):
+            if item.used == 0 and now - item.last_used > self.idle_timeout:
+                del self.clients[key]
+
+        # transport closed when no clients use it
+        used = {x[1:] for x in self.clients}
+        for key in [x for x in self.transports if x not in used]:
+            await self.transports.pop(key).aclose()
+
+    async def aclose(self):
+        transports, self.clients, self.transports = self.transports, {}, {}
+        if self.loop is not asyncio.get_running_loop():
+            return
+
+        for transport in transports.values():
+            await transport.aclose()
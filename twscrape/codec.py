@@ -0,0 +1,63 @@
+"""
+JSON encoding & decoding used for API responses, accounts db columns and models. Uses orjson
+(or msgspec for decoding) when installed, stdlib json otherwise. Backend can be forced with
+`TWS_JSON=orjson|msgspec|json`. Encoded output is compact and not ASCII-escaped with any backend.
+"""
+
+import json
+import os
+from typing import Any, Callable
+
+# optional backends, not installed by default
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec  # type: ignore
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+
+def _pick_backend():
+    name = os.getenv("TWS_JSON", "").lower()
+    if name == "orjson" and orjson is None:
+        raise ImportError("TWS_JSON=orjson, but orjson is not installed")
+    if name == "msgspec" and msgspec is None:
+        raise ImportError("TWS_JSON=msgspec, but msgspec is not installed")
+
+    if name in ("orjson", "msgspec", "json"):
+        return name
+
+    return "orjson" if orjson else "msgspec" if msgspec else "json"
+
+
+BACKEND = _pick_backend()
+
+
+def loads(data: bytes | str) -> Any:
+    if BACKEND == "orjson":
+        return orjson.loads(data)  # type: ignore
+
+    if BACKEND == "msgspec":
+        try:
+            return msgspec.json.decode(data)  # type: ignore
+        except msgspec.DecodeError as e:  # type: ignore
+            # same error type for all backends (orjson's one is subclass of it)
+            doc = data.decode("utf-8", "replace") if isinstance(data, bytes) else data
+            raise json.JSONDecodeError(str(e), doc, 0) from e
+
+    return json.loads(data)
+
+
+def dumps(obj: Any, default: Callable[[Any], Any] | None = None, indent=False) -> str:
+    # msgspec encodes datetimes by itself, so stdlib used to keep `default` behaviour
+    if BACKEND == "orjson":
+        opt = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS  # type: ignore
+        opt |= orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)  # type: ignore
+        return orjson.dumps(obj, default=default, option=opt).decode()  # type: ignore
+
+    if indent:
+        return json.dumps(obj, default=default, indent=2, ensure_ascii=False)
+    return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False)
@@ -1,47 +1,56 @@
 import asyncio
 import random
 import sqlite3
+import threading
 from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, TypeVar
 
 import aiosqlite
 
 from .logger import logger
+from .utils import get_env_bool
 
-MIN_SQLITE_VERSION = "3.24"
+T = TypeVar("T")
 
-_lock = asyncio.Lock()
+MIN_SQLITE_VERSION = "3.24"
+DB_READERS = 3
+DB_BUSY_TIMEOUT = 10_000  # ms, how long sqlite waits for lock held by another connection
+DB_WAL = get_env_bool("TWS_DB_WAL", True)  # can be disabled for network filesystems
 
 
-def lock_retry(max_retries=10):
-    # this lock decorator has double nature:
-    # 1. it uses asyncio lock in same process
-    # 2. it retries when db locked by other process (eg. two cli instances running)
+def lock_retry(max_retries=5):
+    # cross-process contention is handled by sqlite itself (WAL + busy_timeout),
+    # this is only last resort when lock is held longer than busy_timeout
     def decorator(func):
         async def wrapper(*args, **kwargs):
             for i in range(max_retries):
                 try:
-                    async with _lock:
-                        return await func(*args, **kwargs)
+                    return await func(*args, **kwargs)
                 except sqlite3.OperationalError as e:
                     if i == max_retries - 1 or "database is locked" not in str(e):
                         raise e
 
-                    await asyncio.sleep(random.uniform(0.5, 1.0))
+                    logger.debug(f"Database is locked, retrying ({i + 1}/{max_retries})")
+                    await asyncio.sleep(random.uniform(0.1, 0.2) * 2**i)
 
         return wrapper
 
     return decorator
 
 
-async def get_sqlite_version():
-    async with aiosqlite.connect(":memory:") as db:
-        async with db.execute("SELECT SQLITE_VERSION()") as cur:
-            rs = await cur.fetchone()
-            return rs[0] if rs else "3.0.0"
+async def get_sqlite_version(db: aiosqlite.Connection | None = None):
+    if db is None:
+        async with aiosqlite.connect(":memory:") as db:
+            return await get_sqlite_version(db)
+
+    async with db.execute("SELECT SQLITE_VERSION()") as cur:
+        rs = await cur.fetchone()
+        return rs[0] if rs else "3.0.0"
 
 
-async def check_version():
-    ver = await get_sqlite_version()
+async def check_version(db: aiosqlite.Connection | None = None):
+    ver = await get_sqlite_version(db)
     ver = ".".join(ver.split(".")[:2])
 
     try:
@@ -52,10 +61,28 @@ async def check_version():
         pass
 
 
-async def migrate(db: aiosqlite.Connection):
+@asynccontextmanager
+async def transaction(db: aiosqlite.Connection):
+    # IMMEDIATE takes write lock at start, so busy_timeout applies to waiting for it
+    # (deferred transaction upgraded to write can fail with "database is locked" at once)
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+        await db.execute("COMMIT")
+    except BaseException:
+        if db.in_transaction:
+            await db.execute("ROLLBACK")
+        raise
+
+
+async def get_user_version(db: aiosqlite.Connection) -> int:
     async with db.execute("PRAGMA user_version") as cur:
         rs = await cur.fetchone()
-        uv = rs[0] if rs else 0
+        return rs[0] if rs else 0
+
+
+async def migrate(db: aiosqlite.Connection):
+    uv = await get_user_version(db)
 
     async def v1():
         qs = """
@@ -84,75 +111,282 @@ async def migrate(db: aiosqlite.Connection):
     async def v4():
         await db.execute("ALTER TABLE accounts ADD COLUMN mfa_code TEXT DEFAULT NULL")
 
+    async def v5():
+        # move per-queue locks & stats from json columns to indexed table
+        qs = """
+        CREATE TABLE IF NOT EXISTS account_locks (
+            username TEXT NOT NULL COLLATE NOCASE REFERENCES accounts(username) ON DELETE CASCADE,
+            queue TEXT NOT NULL,
+            unlock_at INTEGER DEFAULT 0 NOT NULL,
+            req_count INTEGER DEFAULT 0 NOT NULL,
+            PRIMARY KEY (username, queue)
+        );"""
+        await db.execute(qs)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS account_locks_queue ON account_locks (queue, unlock_at)"
+        )
+
+        qs = """
+        INSERT OR IGNORE INTO account_locks (username, queue, unlock_at, req_count)
+        SELECT a.username, q.key,
+            COALESCE(CAST(strftime('%s', json_extract(a.locks, '$."' || q.key || '"')) AS INTEGER), 0),
+            CASE WHEN json_type(a.stats, '$."' || q.key || '"') = 'integer'
+                THEN json_extract(a.stats, '$."' || q.key || '"') ELSE 0 END
+        FROM accounts a, json_each(json_patch(a.stats, a.locks)) q
+        """
+        await db.execute(qs)
+
+        # every active account gets row for every known queue (same as `ADD_KNOWN_QUEUES`),
+        # otherwise accounts which never used queue before are not leased for it
+        qs = """
+        INSERT OR IGNORE INTO account_locks (username, queue)
+        SELECT a.username, l.queue FROM accounts a, (SELECT DISTINCT queue FROM account_locks) l
+        WHERE a.active = true
+        """
+        await db.execute(qs)
+        await db.execute("UPDATE accounts SET locks = '{}', stats = '{}'")
+
+    async def v6():
+        # last seen x-rate-limit-* headers per account & queue
+        await db.execute(
+            "ALTER TABLE account_locks ADD COLUMN limit_remaining INTEGER DEFAULT NULL"
+        )
+        await db.execute("ALTER TABLE account_locks ADD COLUMN limit_max INTEGER DEFAULT NULL")
+        await db.execute("ALTER TABLE account_locks ADD COLUMN limit_reset INTEGER DEFAULT NULL")
+
+    async def v7():
+        # leased accounts, lock renewed by owner heartbeat and expires if owner is gone
+        await db.execute("ALTER TABLE account_locks ADD COLUMN owner TEXT DEFAULT NULL")
+        qs = "CREATE INDEX IF NOT EXISTS account_locks_owner ON account_locks (owner) WHERE owner IS NOT NULL"
+        await db.execute(qs)
+
+    async def v8():
+        # x-client-transaction-id keys, same for all accounts, reused between runs
+        qs = """
+        CREATE TABLE IF NOT EXISTS xclid_keys (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            vk_bytes TEXT NOT NULL,
+            anim_key TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        );"""
+        await db.execute(qs)
+
+    async def v9():
+        # token buckets of rate limiter, shared by all processes using same db
+        qs = """
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY NOT NULL,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );"""
+        await db.execute(qs)
+
     migrations = {
         1: v1,
         2: v2,
         3: v3,
         4: v4,
+        5: v5,
+        6: v6,
+        7: v7,
+        8: v8,
+        9: v9,
     }
 
     # logger.debug(f"Current migration v{uv} (latest v{len(migrations)})")
     for i in range(uv + 1, len(migrations) + 1):
-        logger.info(f"Running migration to v{i}")
-        try:
-            await migrations[i]()
-        except sqlite3.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                raise e
-
-        await db.execute(f"PRAGMA user_version = {i}")
-        await db.commit()
+        async with transaction(db):
+            if await get_user_version(db) >= i:
+                continue  # already applied by another process
+
+            logger.info(f"Running migration to v{i}")
+            try:
+                await migrations[i]()
+            except sqlite3.OperationalError as e:
+                if "duplicate column name" not in str(e):
+                    raise e
+
+            await db.execute(f"PRAGMA user_version = {i}")
+
+
+async def connect(db_path: str) -> aiosqlite.Connection:
+    # autocommit mode, write transactions are started explicitly with `transaction`
+    conn = aiosqlite.connect(db_path, isolation_level=None)
+    # pooled connections live as long as the process, so their worker threads
+    # should not block interpreter exit (every write is committed right away).
+    # aiosqlite has no public option for it, thread is not started until awaited
+    # (connection is thread itself before 0.22, then it keeps thread in `_thread`)
+    thread = conn if isinstance(conn, threading.Thread) else getattr(conn, "_thread", None)
+    if isinstance(thread, threading.Thread):
+        thread.daemon = True
+
+    db = await conn
+    db.row_factory = aiosqlite.Row
+    await db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}")
+    await db.execute("PRAGMA foreign_keys = ON")
+    return db
 
 
 class DB:
-    _init_queries: defaultdict[str, list[str]] = defaultdict(list)
+    """
+    Long-lived connections to one database file: single writer and several readers.
+    Connections are opened once per process (and event loop) and shared by all callers.
+    In WAL mode readers never block writer (and vice versa), so only writes are serialized.
+    """
+
+    _items: dict[str, "DB"] = {}
     _init_once: defaultdict[str, bool] = defaultdict(bool)
+    _version_checked = False
 
-    def __init__(self, db_path):
+    def __init__(self, db_path: str, readers=DB_READERS):
         self.db_path = db_path
-        self.conn = None
+        # each connection to :memory: is a separate database, so use only one
+        self.readers_count = 0 if db_path == ":memory:" else readers
+        self.loop = asyncio.get_running_loop()
+        self.conns: list[aiosqlite.Connection] = []
+        self.readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self.write_lock = asyncio.Lock()
+        self.conn: aiosqlite.Connection | None = None  # writer
+        self.ready = self.loop.create_task(self._open())
+
+    @classmethod
+    async def get(cls, db_path: str) -> "DB":
+        db_path = str(db_path)
+
+        db = cls._items.get(db_path)
+        if db is not None and db.loop is not asyncio.get_running_loop():
+            # event loop changed (eg. several `asyncio.run` calls), old connections are unusable
+            db.stop()
+            db = None
+
+        if db is None:
+            db = cls._items[db_path] = cls(db_path)
+
+        try:
+            await db.ready
+        except BaseException:
+            if cls._items.get(db_path) is db:
+                del cls._items[db_path]
+            raise
+
+        return db
+
+    @classmethod
+    async def close_all(cls, db_path: str | None = None):
+        for k in list(cls._items.keys()):
+            if db_path is None or k == str(db_path):
+                await cls._items.pop(k).close()
+
+    async def _open(self):
+        self.conn = await connect(self.db_path)
+        self.conns.append(self.conn)
 
-    async def __aenter__(self):
-        await check_version()
-        db = await aiosqlite.connect(self.db_path)
-        db.row_factory = aiosqlite.Row
+        if not DB._version_checked:
+            await check_version(self.conn)
+            DB._version_checked = True
+
+        if DB_WAL:
+            # journal mode is persistent, so it affects all processes using this file
+            await self.conn.execute("PRAGMA journal_mode = WAL")
+            await self.conn.execute("PRAGMA synchronous = NORMAL")
 
         if not self._init_once[self.db_path]:
-            await migrate(db)
+            await migrate(self.conn)
             self._init_once[self.db_path] = True
 
-        self.conn = db
-        return db
+        for _ in range(self.readers_count):
+            conn = await connect(self.db_path)
+            self.conns.append(conn)
+            self.readers.put_nowait(conn)
+
+    async def close(self):
+        conns, self.conns = self.conns, []
+        for conn in conns:
+            await conn.close()
+
+    def stop(self):
+        # without awaiting, loop of connections is gone. `stop()` added in aiosqlite 0.22,
+        # older versions only can end worker thread (sqlite connection closed on gc)
+        conns, self.conns = self.conns, []
+        for conn in conns:
+            if hasattr(conn, "stop"):
+                conn.stop()
+            else:
+                conn._stop_running()  # type: ignore
+
+    @asynccontextmanager
+    async def writer(self):
+        assert self.conn is not None
+        async with self.write_lock:
+            async with transaction(self.conn) as conn:
+                yield conn
+
+    @asynccontextmanager
+    async def reader(self):
+        if self.readers_count == 0:
+            async with self.writer() as conn:
+                yield conn
+            return
+
+        conn = await self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put_nowait(conn)
+
+
+def is_read_query(qs: str):
+    return qs.lstrip()[:6].upper() == "SELECT"
+
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.conn:
-            await self.conn.commit()
-            await self.conn.close()
+async def close(db_path: str | None = None):
+    await DB.close_all(db_path)
+
+
+async def data_version(db_path: str) -> int:
+    # changes only when database modified by other connection (eg. another process)
+    db = await DB.get(db_path)
+    assert db.conn is not None
+    async with db.conn.execute("PRAGMA data_version") as cur:
+        rs = await cur.fetchone()
+        return rs[0] if rs else 0
 
 
 @lock_retry()
 async def execute(db_path: str, qs: str, params: dict | None = None):
-    async with DB(db_path) as db:
-        await db.execute(qs, params)
+    db = await DB.get(db_path)
+    async with db.writer() as conn:
+        await conn.execute(qs, params)
 
 
 @lock_retry()
 async def fetchone(db_path: str, qs: str, params: dict | None = None):
-    async with DB(db_path) as db:
-        async with db.execute(qs, params) as cur:
+    db = await DB.get(db_path)
+    async with db.reader() if is_read_query(qs) else db.writer() as conn:
+        async with conn.execute(qs, params) as cur:
             row = await cur.fetchone()
             return row
 
 
 @lock_retry()
 async def fetchall(db_path: str, qs: str, params: dict | None = None):
-    async with DB(db_path) as db:
-        async with db.execute(qs, params) as cur:
+    db = await DB.get(db_path)
+    async with db.reader() if is_read_query(qs) else db.writer() as conn:
+        async with conn.execute(qs, params) as cur:
             rows = await cur.fetchall()
             return rows
 
 
+@lock_retry()
+async def transact(db_path: str, fn: Callable[[aiosqlite.Connection], Awaitable[T]]) -> T:
+    # run several statements in single write transaction
+    db = await DB.get(db_path)
+    async with db.writer() as conn:
+        return await fn(conn)
+
+
 @lock_retry()
 async def executemany(db_path: str, qs: str, params: list[dict]):
-    async with DB(db_path) as db:
-        await db.executemany(qs, params)
+    db = await DB.get(db_path)
+    async with db.writer() as conn:
+        await conn.executemany(qs, params)
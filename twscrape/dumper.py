@@ -0,0 +1,172 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+from collections import deque
+from dataclasses import dataclass
+
+from httpx import Response
+
+from .logger import logger
+from .utils import get_env_bool, utc
+
+TMP_TS = utc.now().isoformat().split(".")[0].replace("T", "_").replace(":", "-")[0:16]
+
+
+@dataclass
+class DumpItem:
+    count: int
+    title: str
+    status: int
+    username: str
+    request: str
+    headers: list[tuple[str, str]]
+    content: bytes
+
+
+class ResponseDumper:
+    """
+    Writes debug dumps of responses in background thread, so event loop is not blocked.
+    Queue is bounded (responses are dropped when writer can't keep up), only `sample` part of
+    successful responses is written (errors always) and only last `max_files` / `max_mb` of
+    dumps are kept on disk.
+    """
+
+    def __init__(
+        self,
+        outdir: str | None = None,
+        gzip=False,
+        sample=1.0,
+        max_files=10_000,
+        max_mb=512.0,
+        queue_size=1_000,
+    ):
+        self.outdir = outdir or f"/tmp/twscrape-{TMP_TS}"
+        self.gzip = gzip
+        self.sample = sample
+        self.max_files = max_files
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+        self.queue: queue.Queue[DumpItem | None] = queue.Queue(maxsize=queue_size)
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+        self.files: deque[tuple[str, int]] = deque()  # ring of written files (path, size)
+        self.files_size = 0
+        self.count = 0
+        self.stats = {"written": 0, "dropped": 0, "skipped": 0, "deleted": 0, "failed": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            outdir=os.getenv("TWS_DUMP_DIR") or None,
+            gzip=get_env_bool("TWS_DUMP_GZIP"),
+            sample=float(os.getenv("TWS_DUMP_SAMPLE", 1.0)),
+            max_files=int(os.getenv("TWS_DUMP_MAX_FILES", 10_000)),
+            max_mb=float(os.getenv("TWS_DUMP_MAX_MB", 512)),
+        )
+
+    def submit(self, rep: Response, title: str = ""):
+        if rep.status_code < 400 and random.random() >= self.sample:
+            self.stats["skipped"] += 1
+            return
+
+        self.count += 1
+        item = DumpItem(
+            count=self.count,
+            title=title,
+            status=rep.status_code,
+            username=getattr(rep, "__username", "<unknown>"),
+            request=f"{rep.status_code} {rep.request.method} {rep.request.url}",
+            headers=list(rep.headers.items()),
+            content=rep.content,
+        )
+
+        self._start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            if self.stats["dropped"] % 100 == 1:
+                logger.warning(f"Debug dump queue is full, dropped {self.stats['dropped']}")
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True, name="tws-dumper")
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(item)
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Failed to write debug dump: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _write(self, item: DumpItem):
+        msg = []
+        msg.append(f"{item.count:,d} - {item.title}")
+        msg.append(item.request)
+        msg.append("\n")
+        msg.append("\n".join([str(x) for x in item.headers]))
+        msg.append("\n")
+
+        try:
+            msg.append(json.dumps(json.loads(item.content), indent=2))
+        except ValueError:
+            msg.append(item.content.decode("utf-8", "replace"))
+
+        txt = "\n".join(msg).encode()
+        outfile = f"{item.count:05d}_{item.status}_{item.username}.txt"
+        outfile = os.path.join(self.outdir, outfile)
+        if self.gzip:
+            txt, outfile = gzip.compress(txt), f"{outfile}.gz"
+
+        os.makedirs(self.outdir, exist_ok=True)
+        with open(outfile, "wb") as fp:
+            fp.write(txt)
+
+        self.stats["written"] += 1
+        self.files.append((outfile, len(txt)))
+        self.files_size += len(txt)
+
+        while self.files and (
+            len(self.files) > self.max_files or self.files_size > self.max_bytes
+        ):
+            path, size = self.files.popleft()
+            self.files_size -= size
+            self.stats["deleted"] += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+
+_dumper: ResponseDumper | None = None
+
+
+def get_dumper() -> ResponseDumper:
+    global _dumper
+    if _dumper is None:
+        _dumper = ResponseDumper.from_env()
+        atexit.register(_dumper.close)  # write queued dumps before exit
+    return _dumper
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class HedgePolicy:
+    """
+    Hedged requests for single item lookups: if first request is not answered within
+    `percentile` of recent latency of queue, same request is sent with second account and
+    first successful (not None) response is used, other request is cancelled.
+    """
+
+    def __init__(
+        self,
+        percentile=0.95,
+        min_delay=0.1,
+        max_delay=5.0,
+        default_delay=1.0,  # used until `min_samples` latencies are known
+        min_samples=10,
+        window=200,
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.latencies: defaultdict[str, deque[float]] = defaultdict(lambda: deque(maxlen=window))
+        self.stats = {"requests": 0, "hedged": 0, "hedge_won": 0}
+
+    def delay(self, queue: str) -> float:
+        items = self.latencies[queue]
+        if len(items) < self.min_samples:
+            return self.default_delay
+
+        items = sorted(items)
+        value = items[min(len(items) - 1, int(len(items) * self.percentile))]
+        return min(self.max_delay, max(self.min_delay, value))
+
+    async def _timed(self, queue: str, fn: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        try:
+            return await fn()
+        finally:
+            # cancelled request is counted too (as lower bound), so slow ones keep p95 honest
+            self.latencies[queue].append(time.perf_counter() - start)
+
+    async def run(
+        self,
+        queue: str,
+        main: Callable[[], Awaitable[T]],
+        backup: Callable[[], Awaitable[T]],
+    ) -> T:
+        self.stats["requests"] += 1
+        first = asyncio.create_task(self._timed(queue, main))
+        tasks: set[asyncio.Task[Any]] = {first}
+
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay(queue))
+            if not done:
+                self.stats["hedged"] += 1
+                tasks.add(asyncio.create_task(self._timed(queue, backup)))
+
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    ok = not task.cancelled() and task.exception() is None
+                    if ok and task.result() is not None:
+                        self.stats["hedge_won"] += task is not first
+                        return task.result()
+
+            return first.result()  # both failed, error or None of first request returned
+        finally:
+            for task in tasks:
+                task.cancel()
+            # wait for cancelled request to release its account
+            await asyncio.gather(*tasks, return_exceptions=True)
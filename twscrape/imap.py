@@ -81,9 +81,10 @@ async def imap_get_email_code(
         logger.info(f"Waiting for confirmation code for {email}...")
         start_time = time.time()
         while True:
-            _, rep = imap.select("INBOX")
+            # imaplib is blocking, run in thread to not stall other logins
+            _, rep = await asyncio.to_thread(imap.select, "INBOX")
             msg_count = int(rep[0].decode("utf-8")) if len(rep) > 0 and rep[0] is not None else 0
-            code = _wait_email_code(imap, msg_count, min_t)
+            code = await asyncio.to_thread(_wait_email_code, imap, msg_count, min_t)
             if code is not None:
                 return code
 
@@ -99,11 +100,11 @@ async def imap_get_email_code(
 
 async def imap_login(email: str, password: str):
     domain = _get_imap_domain(email)
-    imap = imaplib.IMAP4_SSL(domain)
+    imap = await asyncio.to_thread(imaplib.IMAP4_SSL, domain)
 
     try:
-        imap.login(email, password)
-        imap.select("INBOX", readonly=True)
+        await asyncio.to_thread(imap.login, email, password)
+        await asyncio.to_thread(imap.select, "INBOX", readonly=True)
     except imaplib.IMAP4.error as e:
         logger.error(f"Error logging into {email} on {domain}: {e}")
         raise EmailLoginError() from e
@@ -0,0 +1,201 @@
+"""
+In-process metrics of requests, accounts pool and parsers. Recording is a dict update, so it's
+always on. Read with `snapshot()` (dict) or `render()` (Prometheus text format), or expose them
+on local http endpoint with `await serve(port=9100, pool=pool)`.
+"""
+
+import asyncio
+import bisect
+from typing import Any
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], Any] = {}
+
+    def _labels(self, values: tuple[str, ...]) -> str:
+        if not values:
+            return ""
+        items = [f'{k}="{_escape(str(v))}"' for k, v in zip(self.labels, values)]
+        return "{" + ",".join(items) + "}"
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        return [("", self._labels(k), v) for k, v in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        # per bucket counts (not cumulative), sum, count
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+        item[2] += 1
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        items = []
+        for k, (counts, total, count) in self.values.items():
+            acc = 0
+            for le, n in zip([*self.buckets, "+Inf"], counts):
+                acc += n
+                labels = self._labels(k)[:-1] + "," if k else "{"
+                items.append(("_bucket", f'{labels}le="{le}"}}', acc))
+            items.append(("_sum", self._labels(k), total))
+            items.append(("_count", self._labels(k), count))
+        return items
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def _add(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))  # type: ignore
+
+    def gauge(self, name: str, help: str, labels=()) -> Gauge:
+        return self._add(Gauge(name, help, labels))  # type: ignore
+
+    def histogram(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))  # type: ignore
+
+    def reset(self):
+        for x in self.metrics.values():
+            x.values.clear()
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        res = {}
+        for x in self.metrics.values():
+            values = []
+            for k, v in x.values.items():
+                labels = dict(zip(x.labels, k))
+                if isinstance(x, Histogram):
+                    buckets = dict(zip([*x.buckets, "+Inf"], v[0]))
+                    v = {"buckets": buckets, "sum": v[1], "count": v[2]}
+                values.append({"labels": labels, "value": v})
+            res[x.name] = {"type": x.type, "help": x.help, "values": values}
+        return res
+
+    def render(self) -> str:
+        lines = []
+        for x in self.metrics.values():
+            lines.append(f"# HELP {x.name} {x.help}")
+            lines.append(f"# TYPE {x.name} {x.type}")
+            for suffix, labels, value in x.samples():
+                lines.append(f"{x.name}{suffix}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# QueueClient
+REQUESTS = REGISTRY.counter(
+    "twscrape_requests_total", "API responses by status code", ("queue", "status")
+)
+REQUEST_SECONDS = REGISTRY.histogram("twscrape_request_seconds", "API request latency", ("queue",))
+ERRORS = REGISTRY.counter(
+    "twscrape_errors_total", "API and network errors by type", ("queue", "error")
+)
+RETRIES = REGISTRY.counter(
+    "twscrape_retries_total", "Requests retried after network error", ("queue", "error")
+)
+ACCOUNT_SWITCHES = REGISTRY.counter(
+    "twscrape_account_switches_total", "Account changed during request", ("queue", "reason")
+)
+
+# AccountsPool
+LEASE_WAIT_SECONDS = REGISTRY.histogram(
+    "twscrape_lease_wait_seconds", "Time waiting for available account", ("queue",)
+)
+ACCOUNTS = REGISTRY.gauge(
+    "twscrape_accounts", "Active accounts by state (on last pool stats)", ("queue", "state")
+)
+
+# parsers
+PARSE_ITEMS = REGISTRY.histogram(
+    "twscrape_parse_items", "Items parsed from page", ("kind",), buckets=COUNT_BUCKETS
+)
+PARSE_SECONDS = REGISTRY.histogram(
+    "twscrape_parse_seconds",
+    "Page parse time",
+    ("kind",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+
+def render():
+    return REGISTRY.render()
+
+
+async def serve(port=9100, host="127.0.0.1", pool: Any = None) -> asyncio.Server:
+    """Serve `/metrics` in Prometheus text format, with `pool` accounts gauges are updated."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            path = line.decode("latin-1").split(" ")[1] if line.count(b" ") >= 2 else ""
+            if path.split("?")[0] != "/metrics":
+                status, body = "404 Not Found", b"Not found\n"
+            else:
+                if pool is not None:
+                    await pool.queues_info()
+                status, body = "200 OK", render().encode()
+
+            head = f"HTTP/1.1 {status}\r\ncontent-type: text/plain; version=0.0.4\r\n"
+            head += f"content-length: {len(body)}\r\nconnection: close\r\n\r\n"
+            writer.write(head.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -5,6 +5,7 @@ import random
 import re
 import string
 import sys
+import time
 import traceback
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
@@ -12,8 +13,11 @@ from typing import Generator, Optional, Union
 
 import httpx
 
+from .codec import dumps, loads
 from .logger import logger
-from .utils import find_item, get_or, int_or, to_old_rep, utc
+from .metrics import PARSE_ITEMS, PARSE_SECONDS
+from .tracing import record
+from .utils import find_item, get_or, int_or, rep_json, to_old_rep, utc
 
 
 @dataclass
@@ -22,7 +26,7 @@ class JSONTrait:
         return asdict(self)
 
     def json(self):
-        return json.dumps(self.dict(), default=str)
+        return dumps(self.dict(), default=str)
 
 
 @dataclass
@@ -546,7 +550,7 @@ def _parse_card(obj: dict, url: str):
     if name == "unified_card":
         val = _parse_card_prepare_values(obj)
         val = [x for x in val if x["key"] == "unified_card"][0]["value"]["string_value"]
-        val = json.loads(val)
+        val = loads(val)
 
         co = get_or(val, "component_objects", {})
         do = get_or(val, "destination_objects", {})
@@ -708,25 +712,35 @@ def _parse_items(rep: httpx.Response, kind: str, limit: int = -1):
         raise ValueError(f"Invalid kind: {kind}")
 
     # check for dict, because httpx.Response can be mocked in tests with different type
-    res = rep if isinstance(rep, dict) else rep.json()
+    started_at, start = time.time(), time.perf_counter()
+    res = rep if isinstance(rep, dict) else rep_json(rep)
     obj = to_old_rep(res)
+    took = time.perf_counter() - start
 
     ids = set()
-    for x in obj[key].values():
-        if limit != -1 and len(ids) >= limit:
-            # todo: move somewhere in configuration like force_limit
-            # https://github.com/vladkens/twscrape/issues/26#issuecomment-1656875132
-            # break
-            pass
-
-        try:
-            tmp = Cls.parse(x, obj)
-            if tmp.id not in ids:
-                ids.add(tmp.id)
-                yield tmp
-        except Exception as e:
-            _write_dump(kind, e, x, obj)
-            continue
+    try:
+        for x in obj[key].values():
+            if limit != -1 and len(ids) >= limit:
+                # todo: move somewhere in configuration like force_limit
+                # https://github.com/vladkens/twscrape/issues/26#issuecomment-1656875132
+                # break
+                pass
+
+            try:
+                start = time.perf_counter()
+                tmp = Cls.parse(x, obj)
+                took += time.perf_counter() - start  # consumer time between items not counted
+                if tmp.id not in ids:
+                    ids.add(tmp.id)
+                    yield tmp
+            except Exception as e:
+                _write_dump(kind, e, x, obj)
+                continue
+    finally:
+        PARSE_ITEMS.observe(len(ids), kind)
+        PARSE_SECONDS.observe(took, kind)
+        # generator is consumed between other work, span shows parse time only
+        record("parse", started_at, started_at + took, kind=kind, items=len(ids))
 
 
 # public helpers
@@ -1,19 +1,25 @@
 import asyncio
 import json
-import os
-from typing import Any
+import math
+import time
+from typing import Any, Iterable
 from urllib.parse import urlparse
 
 import httpx
 from httpx import AsyncClient, Response
 
+from .account import RateLimit
 from .accounts_pool import Account, AccountsPool
+from .db import execute, fetchone
+from .dumper import get_dumper
 from .logger import logger
-from .utils import utc
+from .metrics import ACCOUNT_SWITCHES, ERRORS, REQUEST_SECONDS, REQUESTS, RETRIES
+from .retry import RetryPolicy, RetryRule
+from .tracing import span
+from .utils import rep_json, utc
 from .xclid import XClIdGen
 
 ReqParams = dict[str, str | int] | None
-TMP_TS = utc.now().isoformat().split(".")[0].replace("T", "_").replace(":", "-")[0:16]
 
 
 class HandledError(Exception): ...
@@ -23,19 +29,55 @@ class AbortReqError(Exception): ...
 
 
 class XClIdGenStore:
-    items: dict[str, XClIdGen] = {}  # username -> XClIdGen
+    """
+    x-client-transaction-id keys don't depend on account, so single generator is shared.
+    Only one creation runs at a time (other callers wait for it), generator is refreshed in
+    background after `refresh_after` seconds and recreated after `ttl` or on 404 response.
+    Keys are saved to accounts db, so next run (or other process) can reuse them.
+    """
+
+    ttl = 60 * 60
+    refresh_after = 45 * 60
+    gen: XClIdGen | None = None
+    created_at = 0.0
+    task: asyncio.Task | None = None
 
     @classmethod
-    async def get(cls, username: str, fresh=False) -> XClIdGen:
-        if username in cls.items and not fresh:
-            return cls.items[username]
+    async def get(cls, stale: XClIdGen | None = None, db_file: str | None = None) -> XClIdGen:
+        # `stale` – generator rejected by server, recreated once for all concurrent callers
+        if cls.gen is not None and cls.gen is not stale:
+            age = time.time() - cls.created_at
+            if age < cls.ttl:
+                if age > cls.refresh_after:
+                    cls._refresh(db_file)
+                return cls.gen
+
+        return await asyncio.shield(cls._refresh(db_file))
+
+    @classmethod
+    def _refresh(cls, db_file: str | None) -> asyncio.Task:
+        task, loop = cls.task, asyncio.get_running_loop()
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = cls.task = loop.create_task(cls._create(db_file))
+            # background refresh can fail silently, generator recreated on next expiry
+            task.add_done_callback(lambda x: x.cancelled() or x.exception())
+        return task
+
+    @classmethod
+    async def _create(cls, db_file: str | None) -> XClIdGen:
+        if db_file is not None:
+            gen = await cls._load(db_file)
+            if gen is not None:
+                return gen
 
         tries = 0
         while tries < 3:
             try:
-                clid_gen = await XClIdGen.create()
-                cls.items[username] = clid_gen
-                return clid_gen
+                cls.gen = await XClIdGen.create()
+                cls.created_at = time.time()
+                if db_file is not None:
+                    await cls._save(db_file)
+                return cls.gen
             except httpx.HTTPStatusError:
                 tries += 1
                 await asyncio.sleep(1)
@@ -44,26 +86,67 @@ class XClIdGenStore:
             "Faield to create XClIdGen. See: https://github.com/vladkens/twscrape/issues/248"
         )
 
+    @classmethod
+    async def _load(cls, db_file: str) -> XClIdGen | None:
+        # only keys newer than current one, saved by previous run or other process
+        max_age = cls.ttl if cls.gen is None else cls.refresh_after
+        min_ts = max(cls.created_at, time.time() - max_age)
+
+        qs = "SELECT * FROM xclid_keys WHERE created_at > :ts"
+        rs = await fetchone(db_file, qs, {"ts": min_ts})
+        if rs is None:
+            return None
+
+        cls.gen = XClIdGen(json.loads(rs["vk_bytes"]), rs["anim_key"])
+        cls.created_at = rs["created_at"]
+        return cls.gen
+
+    @classmethod
+    async def _save(cls, db_file: str):
+        assert cls.gen is not None
+        qs = """
+        INSERT OR REPLACE INTO xclid_keys (id, vk_bytes, anim_key, created_at)
+        VALUES (0, :vk_bytes, :anim_key, :created_at)
+        """
+        params = {
+            "vk_bytes": json.dumps(cls.gen.vk_bytes),
+            "anim_key": cls.gen.anim_key,
+            "created_at": int(cls.created_at),
+        }
+
+        try:
+            await execute(db_file, qs, params)
+        except Exception as e:
+            logger.warning(f"Failed to save XClIdGen keys: {e}")
+
 
 class Ctx:
-    def __init__(self, acc: Account, clt: AsyncClient):
+    def __init__(
+        self, acc: Account, clt: AsyncClient, db_file: str | None = None, proxy: str | None = None
+    ):
         self.req_count = 0
         self.acc = acc
         self.clt = clt
-
-    async def aclose(self):
-        await self.clt.aclose()
+        self.db_file = db_file
+        self.proxy = proxy
+        self.limit: RateLimit | None = None  # last seen x-rate-limit-* headers
 
     async def req(self, method: str, url: str, params: ReqParams = None) -> Response:
         # if code 404 on first try then generate new x-client-transaction-id and retry
         # https://github.com/vladkens/twscrape/issues/248
         path = urlparse(url).path or "/"
 
-        tries = 0
+        tries, gen = 0, None
         while tries < 3:
-            gen = await XClIdGenStore.get(self.acc.username, fresh=tries > 0)
+            with span("xclid"):
+                gen = await XClIdGenStore.get(stale=gen, db_file=self.db_file)
+
             hdr = {"x-client-transaction-id": gen.calc(method, path)}
-            rep = await self.clt.request(method, url, params=params, headers=hdr)
+            with span("network", attempt=tries + 1) as s:
+                rep = await self.clt.request(method, url, params=params, headers=hdr)
+                if s is not None:
+                    s.attrs["status"] = rep.status_code
+
             if rep.status_code != 404:
                 return rep
 
@@ -87,46 +170,39 @@ def req_id(rep: Response):
 
 
 def dump_rep(rep: Response):
-    count = getattr(dump_rep, "__count", -1) + 1
-    setattr(dump_rep, "__count", count)
-
-    acc = getattr(rep, "__username", "<unknown>")
-    outfile = f"{count:05d}_{rep.status_code}_{acc}.txt"
-    outfile = f"/tmp/twscrape-{TMP_TS}/{outfile}"
-    os.makedirs(os.path.dirname(outfile), exist_ok=True)
-
-    msg = []
-    msg.append(f"{count:,d} - {req_id(rep)}")
-    msg.append(f"{rep.status_code} {rep.request.method} {rep.request.url}")
-    msg.append("\n")
-    # msg.append("\n".join([str(x) for x in list(rep.request.headers.items())]))
-    msg.append("\n".join([str(x) for x in list(rep.headers.items())]))
-    msg.append("\n")
-
-    try:
-        msg.append(json.dumps(rep.json(), indent=2))
-    except json.JSONDecodeError:
-        msg.append(rep.text)
-
-    txt = "\n".join(msg)
-    with open(outfile, "w") as f:
-        f.write(txt)
+    # written in background thread, see `ResponseDumper` for TWS_DUMP_* options
+    get_dumper().submit(rep, req_id(rep))
 
 
 class QueueClient:
-    def __init__(self, pool: AccountsPool, queue: str, debug=False, proxy: str | None = None):
+    def __init__(
+        self,
+        pool: AccountsPool,
+        queue: str,
+        debug=False,
+        proxy: str | None = None,
+        http2=False,
+        retry: RetryPolicy | None = None,
+        wait=True,
+        exclude: Iterable[str] = (),
+    ):
         self.pool = pool
         self.queue = queue
         self.debug = debug
         self.ctx: Ctx | None = None
         self.proxy = proxy
+        self.http2 = http2
+        self.retry = retry or RetryPolicy()
+        self.wait = wait  # wait for account when none available
+        self.exclude = {x.lower() for x in exclude}  # accounts not to use (eg. hedged request)
 
     async def __aenter__(self):
         await self._get_ctx()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._close_ctx()
+        # release account even if task is cancelled again while closing
+        await asyncio.shield(self._close_ctx())
 
     async def _close_ctx(self, reset_at=-1, inactive=False, msg: str | None = None):
         if self.ctx is None:
@@ -134,29 +210,82 @@ class QueueClient:
 
         ctx, self.ctx, self.req_count = self.ctx, None, 0
         username = ctx.acc.username
-        await ctx.aclose()
 
         if inactive:
             await self.pool.mark_inactive(username, msg)
             return
 
+        # client kept open for next session, save cookies updated by server
+        if self.pool.clients.release(ctx.acc, ctx.clt):
+            await self.pool.save_session(ctx.acc)
+
         if reset_at > 0:
-            await self.pool.lock_until(ctx.acc.username, self.queue, reset_at, ctx.req_count)
+            await self.pool.lock_until(
+                ctx.acc.username, self.queue, reset_at, ctx.req_count, ctx.limit
+            )
             return
 
-        await self.pool.unlock(ctx.acc.username, self.queue, ctx.req_count)
+        await self.pool.unlock(ctx.acc.username, self.queue, ctx.req_count, ctx.limit)
 
     async def _get_ctx(self):
         if self.ctx:
             return self.ctx
 
-        acc = await self.pool.get_for_queue_or_wait(self.queue)
-        if acc is None:
-            return None
+        while True:
+            with span("acquire", queue=self.queue) as s:
+                if self.wait:
+                    acc = await self.pool.get_for_queue_or_wait(self.queue)
+                else:
+                    acc = await self.pool.get_for_queue(self.queue)
+
+                if s is not None:
+                    s.attrs["username"] = acc.username if acc else None
 
-        clt = acc.make_client(proxy=self.proxy)
-        self.ctx = Ctx(acc, clt)
-        return self.ctx
+            if acc is None:
+                return None
+
+            if acc.username.lower() in self.exclude:
+                await self.pool.unlock(acc.username, self.queue)
+                return None
+
+            # accounts of failing proxy are skipped until it cools down
+            proxy = acc.get_proxy(self.proxy)
+            open_until = self.pool.breaker.open_until(proxy)
+            if open_until > 0:
+                await self.pool.lock_until(acc.username, self.queue, int(open_until) + 1)
+                continue
+
+            clt = await self.pool.clients.get(acc, proxy=self.proxy, http2=self.http2)
+            self.ctx = Ctx(acc, clt, self.pool._db_file, proxy)
+            return self.ctx
+
+    async def _network_error(self, ctx: Ctx, rule: RetryRule, tries: int, e: Exception):
+        breaker = self.pool.breaker
+        if breaker.failure(ctx.proxy):
+            logger.warning(
+                f"Proxy {ctx.proxy or '<direct>'} failed {breaker.threshold} times in a row, "
+                f"accounts using it are paused for {breaker.cooldown:.0f}s. Last error: {e!r}"
+            )
+
+        if tries >= rule.max_tries:
+            raise e
+
+        RETRIES.inc(self.queue, type(e).__name__)
+
+        # account of paused proxy locked until cooldown ends, with `switch_account` account
+        # locked for backoff delay and next one used without waiting
+        delay = self.retry.delay(rule, tries)
+        logger.debug(f"{e!r}, retry {tries}/{rule.max_tries} in {delay:.2f}s")
+
+        open_until = breaker.open_until(ctx.proxy)
+        if open_until > 0:
+            ACCOUNT_SWITCHES.inc(self.queue, "proxy_paused")
+            await self._close_ctx(int(open_until) + 1)
+        elif rule.switch_account:
+            ACCOUNT_SWITCHES.inc(self.queue, type(e).__name__)
+            await self._close_ctx(utc.ts() + max(1, math.ceil(delay)))
+        else:
+            await asyncio.sleep(delay)
 
     async def _check_rep(self, rep: Response) -> None:
         """
@@ -168,13 +297,18 @@ class QueueClient:
             dump_rep(rep)
 
         try:
-            res = rep.json()
+            res = rep_json(rep)
         except json.JSONDecodeError:
             res: Any = {"_raw": rep.text}
 
         limit_remaining = int(rep.headers.get("x-rate-limit-remaining", -1))
         limit_reset = int(rep.headers.get("x-rate-limit-reset", -1))
-        # limit_max = int(rep.headers.get("x-rate-limit-limit", -1))
+        limit_max = int(rep.headers.get("x-rate-limit-limit", -1))
+
+        # saved to pool on release, used to pick account with most remaining requests
+        if self.ctx is not None and limit_remaining >= 0 and limit_reset > 0:
+            self.ctx.limit = RateLimit(limit_remaining, limit_max, limit_reset)
+            self.pool.set_rate_limit(self.ctx.acc.username, self.queue, self.ctx.limit)
 
         err_msg = "OK"
         if "errors" in res:
@@ -193,28 +327,28 @@ class QueueClient:
         if limit_remaining == 0 and limit_reset > 0:
             logger.debug(f"Rate limited: {log_msg}")
             await self._close_ctx(limit_reset)
-            raise HandledError()
+            raise HandledError("rate_limited")
 
         # no way to check is account banned in direct way, but this check should work
         if err_msg.startswith("(88) Rate limit exceeded") and limit_remaining > 0:
             logger.warning(f"Ban detected: {log_msg}")
             await self._close_ctx(-1, inactive=True, msg=err_msg)
-            raise HandledError()
+            raise HandledError("banned")
 
         if err_msg.startswith("(326) Authorization: Denied by access control"):
             logger.warning(f"Ban detected: {log_msg}")
             await self._close_ctx(-1, inactive=True, msg=err_msg)
-            raise HandledError()
+            raise HandledError("banned")
 
         if err_msg.startswith("(32) Could not authenticate you"):
             logger.warning(f"Session expired or banned: {log_msg}")
             await self._close_ctx(-1, inactive=True, msg=err_msg)
-            raise HandledError()
+            raise HandledError("session_expired")
 
         if err_msg == "OK" and rep.status_code == 403:
             logger.warning(f"Session expired or banned: {log_msg}")
             await self._close_ctx(-1, inactive=True, msg=None)
-            raise HandledError()
+            raise HandledError("session_expired")
 
         # something from twitter side - abort all queries, see: https://github.com/vladkens/twscrape/pull/80
         if err_msg.startswith("(131) Dependency: Internal error"):
@@ -224,6 +358,7 @@ class QueueClient:
                 err_msg = "OK"
             else:
                 logger.warning(f"Dependency error (request skipped): {err_msg}")
+                ERRORS.inc(self.queue, "dependency")
                 raise AbortReqError()
 
         # content not found
@@ -236,6 +371,7 @@ class QueueClient:
             return
 
         if err_msg != "OK":
+            ERRORS.inc(self.queue, "api_error")
             logger.warning(f"API unknown error: {log_msg}")
             return  # ignore any other unknown errors
 
@@ -244,13 +380,22 @@ class QueueClient:
         except httpx.HTTPStatusError:
             logger.error(f"Unhandled API response code: {log_msg}")
             await self._close_ctx(utc.ts() + 60 * 15)  # 15 minutes
-            raise HandledError()
+            raise HandledError("http_error")
 
     async def get(self, url: str, params: ReqParams = None) -> Response | None:
         return await self.req("GET", url, params=params)
 
     async def req(self, method: str, url: str, params: ReqParams = None) -> Response | None:
-        unknown_retry, connection_retry = 0, 0
+        path = urlparse(url).path
+        with span("request", queue=self.queue, method=method, path=path) as s:
+            rep = await self._req(method, url, params)
+            if s is not None and rep is not None:
+                s.attrs["status"] = rep.status_code
+                s.attrs["username"] = getattr(rep, "__username", None)
+            return rep
+
+    async def _req(self, method: str, url: str, params: ReqParams = None) -> Response | None:
+        unknown_retry, network_retry = 0, 0
 
         while True:
             ctx = await self._get_ctx()  # not need to close client, class implements __aexit__
@@ -258,28 +403,36 @@ class QueueClient:
                 return None
 
             try:
+                await self.pool.limiter.acquire(self.queue, ctx.proxy)
+                start = time.perf_counter()
                 rep = await ctx.req(method, url, params=params)
+                REQUEST_SECONDS.observe(time.perf_counter() - start, self.queue)
+                REQUESTS.inc(self.queue, str(rep.status_code))
+                self.pool.breaker.success(ctx.proxy)
                 setattr(rep, "__username", ctx.acc.username)
-                await self._check_rep(rep)
+                with span("check"):
+                    await self._check_rep(rep)
 
                 ctx.req_count += 1  # count only successful
-                unknown_retry, connection_retry = 0, 0
+                unknown_retry, network_retry = 0, 0
                 return rep
             except AbortReqError:
                 # abort all queries
                 return
-            except HandledError:
+            except HandledError as e:
                 # retry with new account
+                ERRORS.inc(self.queue, str(e))
+                ACCOUNT_SWITCHES.inc(self.queue, str(e))
                 continue
-            except (httpx.ReadTimeout, httpx.ProxyError):
-                # http transport failed, just retry with same account
-                continue
-            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
-                # if proxy missconfigured or ???
-                connection_retry += 1
-                if connection_retry >= 3:
-                    raise e
             except Exception as e:
+                # network errors retried with backoff, see `RetryPolicy`
+                ERRORS.inc(self.queue, type(e).__name__)
+                rule = self.retry.rule_for(e)
+                if rule is not None:
+                    network_retry += 1
+                    await self._network_error(ctx, rule, network_retry, e)
+                    continue
+
                 unknown_retry += 1
                 if unknown_retry >= 3:
                     msg = [
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+
+from .db import transact
+from .logger import logger
+from .tracing import span
+
+
+@dataclass
+class Bucket:
+    rate: float  # requests per second
+    burst: float = 1.0  # requests allowed at once after idle
+
+
+def parse_rate_limits(text: str) -> dict[str, Bucket]:
+    # eg. "SearchTimeline=0.5:10,*=2,proxy=5:20" – rate[:burst] of queue, any queue, each proxy
+    limits = {}
+    for item in [x.strip() for x in text.split(",") if x.strip()]:
+        key, value = item.split("=", 1)
+        rate, burst = value.split(":", 1) if ":" in value else (value, 1)
+        limits[key.strip()] = Bucket(float(rate), float(burst))
+    return limits
+
+
+class RateLimiter:
+    """
+    Token buckets per queue and per proxy, stored in accounts db so all processes using it share
+    them. Keys of `limits`: queue name, `*` – every queue without own limit, `proxy` – each proxy
+    (direct connection included). Request takes token from every matching bucket, when bucket is
+    empty token is reserved ahead and caller waits for it, so bursts are spread evenly.
+    """
+
+    def __init__(self, db_file: str, limits: dict[str, Bucket] | None = None):
+        self.db_file = db_file
+        self.limits = limits if limits is not None else self.from_env()
+        self.waited = 0.0  # total seconds spent waiting for tokens, for stats
+
+    @staticmethod
+    def from_env() -> dict[str, Bucket]:
+        return parse_rate_limits(os.getenv("TWS_RATE_LIMITS", ""))
+
+    def buckets(self, queue: str, proxy: str | None) -> list[tuple[str, Bucket]]:
+        items = []
+        if bucket := self.limits.get(queue, self.limits.get("*")):
+            items.append((f"queue:{queue}", bucket))
+        if bucket := self.limits.get("proxy"):
+            items.append((f"proxy:{proxy or ''}", bucket))
+        return items
+
+    async def acquire(self, queue: str, proxy: str | None = None) -> float:
+        buckets = self.buckets(queue, proxy)
+        if not buckets:
+            return 0.0
+
+        async def fn(db):
+            now, wait = time.time(), 0.0
+            for key, bucket in buckets:
+                qs = "SELECT tokens, updated_at FROM rate_buckets WHERE key = :key"
+                async with db.execute(qs, {"key": key}) as cur:
+                    rs = await cur.fetchone()
+
+                tokens = bucket.burst
+                if rs is not None:
+                    tokens = min(bucket.burst, rs[0] + (now - rs[1]) * bucket.rate)
+
+                # negative tokens are reserved by waiting requests
+                tokens -= 1
+                wait = max(wait, -tokens / bucket.rate if tokens < 0 else 0.0)
+
+                qs = """
+                INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (:key, :tokens, :now)
+                ON CONFLICT(key) DO UPDATE
+                SET tokens = excluded.tokens, updated_at = excluded.updated_at
+                """
+                await db.execute(qs, {"key": key, "tokens": tokens, "now": now})
+            return wait
+
+        with span("rate_limit", queue=queue) as s:
+            wait = await transact(self.db_file, fn)
+            if s is not None:
+                s.attrs["wait"] = wait
+
+            if wait > 0:
+                logger.trace(f"Rate limit of {queue} / {proxy or '<direct>'}, waiting {wait:.2f}s")
+                self.waited += wait
+                await asyncio.sleep(wait)
+        return wait
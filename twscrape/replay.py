@@ -0,0 +1,150 @@
+"""
+Record / replay of HTTP responses for offline and reproducible runs. With `TWS_RECORD=path`
+every response received by account clients is appended to gzipped JSON lines archive; with
+`TWS_REPLAY=path` responses are served from archive without network (`TWS_REPLAY_LATENCY`
+is part of recorded response time to wait, eg. 1 – as recorded, 0 – no wait).
+"""
+
+import asyncio
+import base64
+import gzip
+import os
+import time
+from collections import defaultdict
+
+from httpx import AsyncBaseTransport, Request, Response
+
+from .codec import dumps, loads
+from .logger import logger
+
+# already decoded by httpx, body stored as is
+SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+# live session cookies, not stored in archive (replayed client would copy them to account)
+SECRET_HEADERS = {"set-cookie"}
+
+
+def _encode_entry(req: Request, rep: Response, content: bytes, elapsed: float):
+    try:
+        body = {"text": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        body = {"b64": base64.b64encode(content).decode()}
+
+    skip = SKIP_HEADERS | SECRET_HEADERS
+    headers = [(k, v) for k, v in rep.headers.items() if k.lower() not in skip]
+    doc = {"method": req.method, "url": str(req.url), "status": rep.status_code}
+    doc.update({"headers": headers, "elapsed": round(elapsed, 4), "ts": int(time.time())})
+    return dumps({**doc, **body})
+
+
+class Recorder:
+    items: dict[str, "Recorder"] = {}  # path -> Recorder
+
+    @classmethod
+    def get(cls, path: str) -> "Recorder":
+        if path not in cls.items:
+            cls.items[path] = Recorder(path)
+        return cls.items[path]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fp: gzip.GzipFile | None = None
+
+    def write(self, line: str):
+        fp = self.fp
+        if fp is None:
+            # each run appended as new gzip member, archive still readable as one file
+            fp = self.fp = gzip.open(self.path, "ab")
+        fp.write(line.encode() + b"\n")
+        fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+class RecordTransport(AsyncBaseTransport):
+    def __init__(self, transport: AsyncBaseTransport, path: str):
+        self.transport = transport
+        self.recorder = Recorder.get(path)
+
+    async def handle_async_request(self, request: Request) -> Response:
+        start = time.perf_counter()
+        rep = await self.transport.handle_async_request(request)
+        try:
+            content = await rep.aread()
+        finally:
+            await rep.aclose()
+
+        elapsed = time.perf_counter() - start
+        self.recorder.write(_encode_entry(request, rep, content, elapsed))
+
+        headers = [(k, v) for k, v in rep.headers.items() if k.lower() not in SKIP_HEADERS]
+        return Response(rep.status_code, headers=headers, content=content)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayTransport(AsyncBaseTransport):
+    """
+    Serves recorded responses: same url in recorded order (repeated from start when ends),
+    unknown url – any response recorded for same path. `x-rate-limit-reset` is moved to keep
+    same time left to reset as at recording.
+    """
+
+    archives: dict[str, list[dict]] = {}  # path -> entries
+
+    def __init__(self, path: str, latency=0.0):
+        if path not in self.archives:
+            with gzip.open(path, "rb") as fp:
+                self.archives[path] = [loads(x) for x in fp if x.strip()]
+
+        self.latency = latency
+        self.by_url: defaultdict[tuple[str, str], list[dict]] = defaultdict(list)
+        self.by_path: defaultdict[tuple[str, str], list[dict]] = defaultdict(list)
+        self.served: defaultdict[tuple, int] = defaultdict(int)
+
+        for x in self.archives[path]:
+            self.by_url[(x["method"], x["url"])].append(x)
+            self.by_path[(x["method"], x["url"].split("?")[0])].append(x)
+
+    def _pick(self, req: Request) -> dict | None:
+        url = str(req.url)
+        for key, index in [
+            ((req.method, url), self.by_url),
+            ((req.method, url.split("?")[0]), self.by_path),
+        ]:
+            items = index.get(key)
+            if items:
+                idx = self.served[(id(index), key)]
+                self.served[(id(index), key)] += 1
+                return items[idx % len(items)]
+
+        return None
+
+    async def handle_async_request(self, request: Request) -> Response:
+        doc = self._pick(request)
+        if doc is None:
+            logger.warning(f"No recorded response for {request.method} {request.url}")
+            return Response(404, json={"errors": [{"message": "Not recorded"}]})
+
+        if self.latency > 0:
+            await asyncio.sleep(doc["elapsed"] * self.latency)
+
+        headers = []
+        for k, v in doc["headers"]:
+            if k.lower() == "x-rate-limit-reset":
+                v = str(int(v) - doc["ts"] + int(time.time()))
+            headers.append((k, v))
+
+        content = doc["text"].encode() if "text" in doc else base64.b64decode(doc["b64"])
+        return Response(doc["status"], headers=headers, content=content)
+
+
+def wrap_transport(transport: AsyncBaseTransport) -> AsyncBaseTransport:
+    if path := os.getenv("TWS_REPLAY"):
+        return ReplayTransport(path, latency=float(os.getenv("TWS_REPLAY_LATENCY", 0)))
+    if path := os.getenv("TWS_RECORD"):
+        return RecordTransport(transport, path)
+    return transport
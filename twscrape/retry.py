@@ -0,0 +1,72 @@
+import random
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+
+@dataclass
+class RetryRule:
+    errors: tuple[type[Exception], ...]
+    max_tries: int = 3  # error raised after this number of failures in a row
+    backoff: float = 0.5  # first delay, doubled on every next failure (with jitter)
+    max_backoff: float = 10.0
+    switch_account: bool = False  # retry with another account (and possibly proxy)
+
+
+@dataclass
+class RetryPolicy:
+    """Network errors handling of `QueueClient.req`, first rule matching error is used."""
+
+    rules: list[RetryRule] = field(
+        default_factory=lambda: [
+            RetryRule((httpx.ReadTimeout, httpx.WriteTimeout), max_tries=5, backoff=0.25),
+            RetryRule((httpx.ProxyError,), max_tries=5, backoff=0.5, switch_account=True),
+            RetryRule((httpx.ConnectError, httpx.ConnectTimeout), switch_account=True, backoff=1),
+        ]
+    )
+
+    def rule_for(self, e: Exception) -> RetryRule | None:
+        return next((x for x in self.rules if isinstance(e, x.errors)), None)
+
+    def delay(self, rule: RetryRule, tries: int) -> float:
+        # "equal jitter": at least half of exponential delay, so clients don't retry in sync
+        delay = min(rule.max_backoff, rule.backoff * 2 ** (tries - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+@dataclass
+class ProxyState:
+    failures: int = 0  # in a row
+    open_until: float = 0.0
+
+
+class CircuitBreaker:
+    """
+    Per-proxy circuit breaker: after `threshold` network failures in a row proxy is open
+    (not used) for `cooldown` seconds. After cooldown next request is a probe – success closes
+    breaker, failure opens it again. `None` key is direct connection.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.proxies: dict[str | None, ProxyState] = {}
+
+    def open_until(self, proxy: str | None) -> float:
+        state = self.proxies.get(proxy, None)
+        return state.open_until if state and state.open_until > time.time() else 0.0
+
+    def success(self, proxy: str | None):
+        state = self.proxies.get(proxy, None)
+        if state is not None:
+            state.failures, state.open_until = 0, 0.0
+
+    def failure(self, proxy: str | None) -> bool:
+        """Returns True if breaker opened by this failure."""
+        state = self.proxies.setdefault(proxy, ProxyState())
+        state.failures += 1
+        if state.failures >= self.threshold and state.open_until <= time.time():
+            state.open_until = time.time() + self.cooldown
+            return True
+        return False
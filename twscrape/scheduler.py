@@ -0,0 +1,111 @@
+import heapq
+
+from .account import UNKNOWN_BUDGET, Account, RateLimit
+from .utils import utc
+
+
+class AccountsScheduler:
+    """
+    In-process index of active accounts used by `AccountsPool` to lease accounts without
+    reading database. For every queue keeps min-heap of locked accounts by unlock time and
+    heap of ready accounts ordered by rate limit budget (same as `ORDER_BY_BUDGET`), so
+    lease / release is O(log n). Heaps entries are not removed on update, outdated ones are
+    skipped when popped. Budget is evaluated when account is released.
+    """
+
+    def __init__(self, accounts: list[Account], limits: list[tuple[str, str, RateLimit]]):
+        self.accounts = {x.username.lower(): x for x in accounts if x.active}
+        self.unlock_at: dict[str, dict[str, int]] = {}  # queue -> username -> unlock_at
+        self.locked: dict[str, list[tuple[int, str]]] = {}  # queue -> [(unlock_at, username)]
+        self.ready: dict[str, list[tuple[tuple, str]]] = {}  # queue -> [(order_key, username)]
+
+        self.limits: dict[str, dict[str, RateLimit]] = {}  # queue -> username -> RateLimit
+        for username, queue, limit in limits:
+            self.limits.setdefault(queue, {})[username.lower()] = limit
+
+    def _order_key(self, queue: str, key: str, now: int):
+        limit = self.limits.get(queue, {}).get(key, None)
+        if limit is None:
+            return (-UNKNOWN_BUDGET, 0, key)
+        return (-limit.budget(now), limit.reset, key)
+
+    def _init_queue(self, queue: str, now: int):
+        if queue in self.unlock_at:
+            return
+
+        self.unlock_at[queue], self.locked[queue], self.ready[queue] = {}, [], []
+        for key, acc in self.accounts.items():
+            lock = acc.locks.get(queue, None)
+            self._push(queue, key, int(lock.timestamp()) if lock else 0, now)
+
+    def _push(self, queue: str, key: str, unlock_at: int, now: int):
+        # same as db lock condition (`unlock_at < now` is free)
+        self.unlock_at[queue][key] = unlock_at
+        if unlock_at >= now:
+            heapq.heappush(self.locked[queue], (unlock_at, key))
+        else:
+            heapq.heappush(self.ready[queue], (self._order_key(queue, key, now), key))
+
+    def _promote(self, queue: str, now: int):
+        locked, state = self.locked[queue], self.unlock_at[queue]
+        while locked and locked[0][0] < now:
+            unlock_at, key = heapq.heappop(locked)
+            if state.get(key) == unlock_at:
+                heapq.heappush(self.ready[queue], (self._order_key(queue, key, now), key))
+
+    def set(
+        self,
+        username: str,
+        queue: str,
+        unlock_at: int,
+        req_count=0,
+        limit: RateLimit | None = None,
+    ):
+        key, now = username.lower(), utc.ts()
+        acc = self.accounts.get(key, None)
+        if acc is None:
+            return
+
+        if limit is not None:
+            self.limits.setdefault(queue, {})[key] = limit
+
+        self._init_queue(queue, now)
+        self._push(queue, key, unlock_at, now)
+
+        acc.stats[queue] = acc.stats.get(queue, 0) + req_count
+        if unlock_at > 0:
+            acc.locks[queue] = utc.from_ts(unlock_at)
+        else:
+            acc.locks.pop(queue, None)
+
+    def lease(self, queue: str, lock_at: int) -> Account | None:
+        now = utc.ts()
+        self._init_queue(queue, now)
+        self._promote(queue, now)
+
+        ready, state = self.ready[queue], self.unlock_at[queue]
+        while ready:
+            _, key = heapq.heappop(ready)
+            if state.get(key, 0) < now:
+                # lock right away, so account can't be leased twice while saving to db
+                self.set(key, queue, lock_at)
+                return self.accounts[key]
+
+        return None
+
+    def next_unlock(self, queue: str) -> int | None:
+        now = utc.ts()
+        self._init_queue(queue, now)
+        self._promote(queue, now)
+
+        ready, locked, state = self.ready[queue], self.locked[queue], self.unlock_at[queue]
+        while ready and state.get(ready[0][1], 0) >= now:
+            heapq.heappop(ready)
+
+        if ready:
+            return now
+
+        while locked and state.get(locked[0][1]) != locked[0][0]:
+            heapq.heappop(locked)
+
+        return locked[0][0] if locked else None
@@ -0,0 +1,136 @@
+"""
+Tracing hooks: phases of every request (acquire account, rate limit, xclid, network, check,
+parse) are reported as spans to hooks set with `set_hooks()`. Spans are nested (request in page,
+network in request, etc.), so waterfall of paginated call can be built from them. Nothing is
+recorded when no hooks set. `OpenTelemetryHooks` exports spans with `opentelemetry-api`.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+
+@dataclass
+class Span:
+    name: str
+    attrs: dict[str, Any]
+    parent: "Span | None" = None
+    start: float = 0.0
+    end: float | None = None
+    error: BaseException | None = None
+    data: Any = None  # for hooks, eg. span of tracing library
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+
+class TracingHooks:
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        pass
+
+
+_hooks: TracingHooks | None = None
+_current: ContextVar[Span | None] = ContextVar("twscrape_span", default=None)
+
+
+def set_hooks(hooks: TracingHooks | None):
+    global _hooks
+    _hooks = hooks
+
+
+@contextmanager
+def span(name: str, **attrs: Any):
+    hooks = _hooks
+    if hooks is None:
+        yield None
+        return
+
+    item = Span(name, attrs, _current.get(), time.time())
+    hooks.on_start(item)
+    token = _current.set(item)
+    try:
+        yield item
+    except BaseException as e:
+        item.error = e
+        raise
+    finally:
+        _current.reset(token)
+        item.end = time.time()
+        hooks.on_end(item)
+
+
+def record(name: str, start: float, end: float, **attrs: Any):
+    # span measured by caller, for code which can't keep context open (eg. generators)
+    hooks = _hooks
+    if hooks is None:
+        return
+
+    item = Span(name, attrs, _current.get(), start)
+    hooks.on_start(item)
+    item.end = end
+    hooks.on_end(item)
+
+
+@dataclass
+class SpanRecorder(TracingHooks):
+    """Keeps finished spans in memory, `waterfall()` renders them as text."""
+
+    spans: list[Span] = field(default_factory=list)
+
+    def on_end(self, span: Span):
+        self.spans.append(span)
+
+    def waterfall(self, width=40) -> str:
+        if not self.spans:
+            return ""
+
+        def depth(x: Span):
+            return 0 if x.parent is None else depth(x.parent) + 1
+
+        t0 = min(x.start for x in self.spans)
+        total = max(x.end or x.start for x in self.spans) - t0 or 1.0
+        lines = []
+        for x in sorted(self.spans, key=lambda x: (x.start, -x.duration)):
+            pos = int((x.start - t0) / total * width)
+            bar = " " * pos + "#" * max(1, int(x.duration / total * width))
+            name = "  " * depth(x) + x.name
+            lines.append(f"{name:<24} {bar:<{width + 1}} {x.duration * 1000:8.1f}ms")
+        return "\n".join(lines)
+
+
+class OpenTelemetryHooks(TracingHooks):
+    """Exports spans to OpenTelemetry tracer, requires `twscrape[otel]` (and SDK to export)."""
+
+    def __init__(self, tracer: Any = None):
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError("OpenTelemetryHooks requires `pip install twscrape[otel]`") from e
+
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer("twscrape")
+
+    def on_start(self, span: Span):
+        # parent given explicitly, so otel context is not attached (spans can cross tasks)
+        parent = span.parent.data if span.parent is not None else None
+        ctx = self.trace.set_span_in_context(parent) if parent is not None else None
+        span.data = self.tracer.start_span(
+            span.name, context=ctx, start_time=int(span.start * 1e9)
+        )
+
+    def on_end(self, span: Span):
+        if span.data is None:
+            return
+
+        attrs = {k: v for k, v in span.attrs.items() if v is not None}
+        span.data.set_attributes({f"twscrape.{k}": v for k, v in attrs.items()})
+        if span.error is not None:
+            span.data.record_exception(span.error)
+            span.data.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.data.end(end_time=int((span.end or time.time()) * 1e9))
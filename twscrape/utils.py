@@ -1,13 +1,38 @@
+import asyncio
 import base64
+import functools
 import json
 import os
+import random
 from collections import defaultdict
+from contextlib import aclosing
 from datetime import datetime, timezone
 from typing import Any, AsyncGenerator, Callable, TypeVar
 
+from fake_useragent import UserAgent
+
+from .codec import dumps, loads
+
 T = TypeVar("T")
 
 
+_UA_SAMPLES = 50
+
+
+@functools.cache
+def _user_agents() -> tuple[UserAgent, dict[str, list[str]]]:
+    return UserAgent(), defaultdict(list)  # loads browsers data file, so create once
+
+
+def get_user_agent(browser="safari") -> str:
+    # each UserAgent lookup filters whole data file (~10ms), so reuse limited sample
+    ua, samples = _user_agents()
+    if len(samples[browser]) < _UA_SAMPLES:
+        samples[browser].append(getattr(ua, browser))
+        return samples[browser][-1]
+    return random.choice(samples[browser])
+
+
 class utc:
     @staticmethod
     def now() -> datetime:
@@ -17,6 +42,10 @@ class utc:
     def from_iso(iso: str) -> datetime:
         return datetime.fromisoformat(iso).replace(tzinfo=timezone.utc)
 
+    @staticmethod
+    def from_ts(ts: int) -> datetime:
+        return datetime.fromtimestamp(ts, timezone.utc)
+
     @staticmethod
     def ts() -> int:
         return int(utc.now().timestamp())
@@ -29,18 +58,69 @@ async def gather(gen: AsyncGenerator[T, None]) -> list[T]:
     return items
 
 
+async def prefetch(gen: AsyncGenerator[T, None], size: int) -> AsyncGenerator[T, None]:
+    """
+    Iterates `gen` in background task, up to `size` items ahead of consumer. Errors of `gen` are
+    raised to consumer, `gen` is closed (cancelled) when consumer stops.
+    """
+    slots = asyncio.Semaphore(size)
+    items: asyncio.Queue[tuple[bool, Any]] = asyncio.Queue()  # (is_item, item or error)
+
+    async def produce():
+        try:
+            async with aclosing(gen) as it:
+                while True:
+                    await slots.acquire()
+                    try:
+                        items.put_nowait((True, await anext(it)))
+                    except StopAsyncIteration:
+                        break
+            items.put_nowait((False, None))
+        except Exception as e:
+            items.put_nowait((False, e))
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            is_item, item = await items.get()
+            if not is_item:
+                if item is not None:
+                    raise item
+                return
+
+            slots.release()  # next item fetched while consumer processes this one
+            yield item
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)  # wait for gen cleanup
+
+
 def encode_params(obj: dict):
     res = {}
     for k, v in obj.items():
         if isinstance(v, dict):
             v = {a: b for a, b in v.items() if b is not None}
-            v = json.dumps(v, separators=(",", ":"))
+            v = dumps(v)
 
         res[k] = str(v)
 
     return res
 
 
+def rep_json(rep) -> Any:
+    # response decoded once and cached on it, then reused by QueueClient, API & parsers
+    res = getattr(rep, "__json", _NOT_SET)
+    if res is _NOT_SET:
+        # from raw bytes, without decoding to text first
+        content = getattr(rep, "content", None)
+        res = loads(content) if content is not None else rep.json()
+        setattr(rep, "__json", res)
+    return res
+
+
+_NOT_SET = object()
+
+
 def get_or(obj: dict, key: str, default_value: T = None) -> Any | T:
     for part in key.split("."):
         if part not in obj:
@@ -194,7 +274,7 @@ def parse_cookies(val: str) -> dict[str, str]:
 
     try:
         try:
-            res = json.loads(val)
+            res = loads(val)
             if isinstance(res, dict) and "cookies" in res:
                 res = res["cookies"]
 
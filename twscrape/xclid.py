@@ -8,12 +8,15 @@ import time
 
 import bs4
 import httpx
-from fake_useragent import UserAgent
+
+from .replay import wrap_transport
+from .utils import get_user_agent
 
 
 def _make_client() -> httpx.AsyncClient:
-    headers = {"user-agent": UserAgent().chrome}
-    return httpx.AsyncClient(headers=headers, follow_redirects=True)
+    headers = {"user-agent": get_user_agent("chrome")}
+    transport = wrap_transport(httpx.AsyncHTTPTransport())
+    return httpx.AsyncClient(headers=headers, follow_redirects=True, transport=transport)
 
 
 async def get_tw_page_text(url: str, clt: httpx.AsyncClient | None = None):